@@ -0,0 +1,37 @@
+# bench_pdf.py
+# Замер text_to_pdf: без кэша шаблонов (как было) и с прогретым кэшем.
+# Запуск: python bench_pdf.py [повторов]
+
+import sys
+import time
+import pdf_generator
+from pdf_generator import text_to_pdf, get_headers_for_product, COLOR_MAP
+
+def sample_text(product_type):
+    body = "Звёзды говорят: " + "мягкие лапы, острые когти, долгий сон. " * 60
+    blocks = []
+    for header in get_headers_for_product(product_type):
+        blocks += [header, body, body]
+    return "\n\n".join(blocks)
+
+def bench(product_type, runs, cold):
+    text = sample_text(product_type)
+    timings = []
+    for _ in range(runs):
+        if cold:
+            pdf_generator._templates.clear()
+            pdf_generator._images.clear()
+        started = time.perf_counter()
+        text_to_pdf(text, product_type=product_type)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print(f"{'product':<15}{'cold, ms':>12}{'cached, ms':>12}{'speedup':>10}")
+    for product_type in COLOR_MAP:
+        cold = bench(product_type, runs, cold=True)
+        bench(product_type, 1, cold=False)  # прогрев кэша
+        warm = bench(product_type, runs, cold=False)
+        print(f"{product_type:<15}{cold * 1000:>12.1f}{warm * 1000:>12.1f}{cold / warm:>9.1f}x")
@@ -16,9 +16,24 @@ from handlers import (
     COMPAT_NAME, COMPAT_DATE, COMPAT_TIME, COMPAT_LOCATION,
     READY, DATE, TIME, LOCATION
 )
+from generation import run_job
+from pdf_generator import warm_render_pool, shutdown_render_pool
+from update_processor import PerChatUpdateProcessor
+import metrics
+import report_queue
+import users_repo
+import storage
+import stripe_client
+import llm_cache
+import openai_client
+import model_router
 
 load_dotenv()
 TG_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# polling — как раньше; webhook — бот и Stripe обслуживает один ASGI-процесс (server.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Сколько апдейтов обрабатываем одновременно (апдейты одного чата — всё равно по очереди)
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -35,12 +50,52 @@ COMMANDS = [
 async def set_commands(app):
     await app.bot.set_my_commands(COMMANDS)
 
-if __name__ == "__main__":
-    app = ApplicationBuilder().token(TG_TOKEN).build()
+def register_metrics():
+    # Счётчики и очереди модулей бота снимаются при каждом запросе /metrics
+    metrics.register_stats("report_queue", report_queue.stats)
+    metrics.register_stats("llm_cache", llm_cache.stats, counters=("hits", "misses", "writes", "evictions"))
+    metrics.register_stats(
+        "openai", openai_client.stats, counters=("calls", "retries", "failures", "rejected", "breaker_opens")
+    )
+    metrics.register_stats("openai_limiter", openai_client.limiter.stats, counters=("granted",))
+    metrics.register_stats("model", lambda: model_router.stats()["models"], label="model")
+    metrics.register_stats("storage", storage.stats, counters=("uploads", "dedup_hits", "bytes_uploaded"))
+    metrics.register_stats("checkout_cache", stripe_client.stats, counters=("hits", "misses"))
+    metrics.register_stats(
+        "user_cache", users_repo.user_cache.stats, counters=("hits", "misses", "evictions")
+    )
+
+# Команды, воркеры очереди отчётов и пул рендера PDF поднимаются до первого апдейта
+async def on_startup(app):
+    await set_commands(app)
+    await warm_render_pool()
+    await report_queue.start_workers(app, run_job)
+    register_metrics()
+    if app.updater is not None:
+        # В polling у бота нет своего HTTP-сервера — /metrics отдаём на METRICS_PORT.
+        # В режиме webhook /metrics отдаёт server.py
+        await metrics.start_server()
 
-    # Добавляем команды в меню Telegram при старте
-    import asyncio
-    asyncio.get_event_loop().run_until_complete(set_commands(app))
+async def on_shutdown(app):
+    await metrics.stop_server()
+    await report_queue.stop_workers()
+    shutdown_render_pool()
+    await users_repo.close()
+    await storage.close()
+    await stripe_client.close()
+
+def build_application(updater=True):
+    builder = (
+        ApplicationBuilder()
+        .token(TG_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(BOT_CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if not updater:
+        # В режиме webhook апдейты кладёт в очередь server.py
+        builder = builder.updater(None)
+    app = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -86,6 +141,12 @@ if __name__ == "__main__":
     app.add_handler(CallbackQueryHandler(income_card_callback, pattern=r"^income_card$"))
     app.add_handler(MessageHandler(filters.Regex(r"^💞 Совместимость по дате рождения$"), compatibility_product))
     app.add_handler(MessageHandler(filters.Regex(r"^Проверить совместимость$"), start_compatibility))
+    return app
 
-    logger.info("Bot started")
-    app.run_polling()
\ No newline at end of file
+if __name__ == "__main__":
+    if BOT_MODE == "webhook":
+        import server
+        server.run()
+    else:
+        logger.info("Bot started (polling)")
+        build_application().run_polling()
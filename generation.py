@@ -1,79 +1,429 @@
 # generation.py
-from pdf_generator import text_to_pdf, upload_pdf_to_storage
-from prompts import build_destiny_prompt_part1, build_destiny_prompt_part2
-from openai_client import ask_gpt
-from supabase_client import get_user
+import os
+import time
+import asyncio
+from io import BytesIO
+from contextlib import contextmanager
+from pdf_generator import render_pdf, get_headers_for_product
+from prompts import (
+    build_destiny_prompt_part1, build_destiny_prompt_part2,
+    build_solyar_prompt_part1, build_solyar_prompt_part2,
+    build_income_prompt_part1, build_income_prompt_part2,
+    build_compatibility_prompt_part1, build_compatibility_prompt_part2,
+)
+from openai_client import ask_gpt_async, CircuitOpenError
+from rate_limiter import PRIORITY_HIGH, PRIORITY_LOW
+import users_repo
+import report_queue
+import llm_cache
+import model_router
+import report_store
+import storage
+import metrics
+import tracing
+from telegram import ReplyKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.constants import ParseMode
 from datetime import datetime
 
-async def generate_and_send_destiny(application, tg_id):
-    # Получаем пользователя
-    user_list = get_user(tg_id)
-    if not user_list:
-        return
-    user = user_list[0]
-    
-    # Подготовка промпта
+# Сколько раз повторяем одну упавшую часть отчёта (вторая при этом не перезапрашивается).
+# 429/5xx/таймауты уже повторяет openai_client — здесь только поверх его повторов
+GPT_PART_RETRIES = int(os.getenv("GPT_PART_RETRIES", "0"))
+# Не чаще раза в столько секунд обновляем подпись «загрузки» с прогрессом
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "2.5"))
+
+@contextmanager
+def _stage(stage, product_type, **attrs):
+    # Этап отчёта: гистограмма в metrics и спан в трассе заказа
+    with metrics.STAGE_SECONDS.time(stage=stage, product=product_type):
+        with tracing.span(stage, product=product_type, **attrs) as span_attrs:
+            yield span_attrs
+
+class ReportGenerationError(Exception):
+    def __init__(self, parts, errors):
+        super().__init__(f"{len(errors)} report part(s) failed: {errors}")
+        # parts — готовые части (None на месте упавших); generate_and_send сохраняет их
+        # в report_store, и следующая попытка передаёт их обратно в generate_report_text
+        self.parts = parts
+        self.errors = errors
+
+async def _ask_part(index, messages, product_type=None, on_progress=None, **gpt_kwargs):
+    if on_progress:
+        gpt_kwargs["on_text"] = lambda text: on_progress(index, text)
+    stage = f"gpt_part{index + 1}"
+    labels = {"product": product_type or "", "part": str(index + 1)}
+    with _stage(stage, labels["product"]):
+        for attempt in range(GPT_PART_RETRIES + 1):
+            try:
+                # Модель и параметры продукта берём из model_router на каждую попытку
+                route = model_router.params(product_type) if product_type else {}
+                text = await ask_gpt_async(messages, **route, labels=labels, **gpt_kwargs)
+                if on_progress:
+                    on_progress(index, text, finished=True)
+                return text
+            except Exception as e:
+                print(f"GPT error (part {index + 1}, attempt {attempt + 1}):", e)
+                last_error = e
+                # OpenAI деградировал — повтор сразу же тоже получит отказ
+                if isinstance(e, CircuitOpenError):
+                    break
+    metrics.FAILURES.inc(stage=stage, product=labels["product"])
+    raise last_error
+
+async def generate_report_text(*messages_parts, parts=None, **gpt_kwargs):
+    # Все части запрашиваются одновременно и склеиваются в исходном порядке.
+    # parts — результат прошлой попытки: уже готовые части повторно не оплачиваем.
+    # on_progress(index, text, finished=False) — включает потоковый режим GPT.
+    # product_type — модель, max_tokens и temperature выбирает model_router.
+    parts = list(parts) if parts else [None] * len(messages_parts)
+    pending = [i for i, part in enumerate(parts) if part is None]
+    results = await asyncio.gather(
+        *(_ask_part(i, messages_parts[i], **gpt_kwargs) for i in pending),
+        return_exceptions=True,
+    )
+    errors = {}
+    for i, result in zip(pending, results):
+        if isinstance(result, BaseException):
+            errors[i] = result
+        else:
+            parts[i] = result
+    if errors:
+        raise ReportGenerationError(parts, errors)
+    return "\n\n".join(part.strip() for part in parts)
+
+# Всё, что отличает продукты друг от друга при генерации и отправке
+REPORTS = {
+    "destiny": dict(
+        prompts=(build_destiny_prompt_part1, build_destiny_prompt_part2),
+        pdf_field="destiny_pdf_url",
+        file_id_field="destiny_pdf_file_id",
+        filename="Karta_Prednaznacheniya.pdf",
+        caption=(
+            "Мяу, миссия выполнена! Вот твоя личная натальная карта — не сырая копия из интернета, а настоящий кото-разбор с характером.\n"
+            "Изучи внимательно, мурлыкни благодарность звёздам и помни — даже самая мудрая кошка иногда промахивается, но всегда падает на лапы. Вперёд к своему предназначению!"
+        ),
+        txt_name="destiny.txt",
+        txt_caption="Карта готова, но PDF не прикрепился. Вот текст:",
+    ),
+    "solyar": dict(
+        prompts=(build_solyar_prompt_part1, build_solyar_prompt_part2),
+        pdf_field="solyar_pdf_url",
+        file_id_field="solyar_pdf_file_id",
+        filename="Solyar_Report.pdf",
+        caption="Мяу, всё готово! Вот твой личный прогноз на год — разбор от АстроКотского. Изучи внимательно, найди сильные и сложные периоды, и помни: твой год — это территория для свершений.",
+        txt_name="solyar.txt",
+        txt_caption="Разбор готов, но PDF не прикрепился. Вот текст:",
+    ),
+    "income": dict(
+        prompts=(build_income_prompt_part1, build_income_prompt_part2),
+        pdf_field="income_pdf_url",
+        file_id_field="income_pdf_file_id",
+        filename="Income_Report.pdf",
+        caption="Вот твой астрологический разбор по деньгам и карьере! Тут написано всё, что нужно. Если что не так — кидай валерьянку, буду думать ещё.",
+        txt_name="income.txt",
+        txt_caption="Разбор готов, но PDF не прикрепился. Вот текст:",
+    ),
+    "compatibility": dict(
+        prompts=(build_compatibility_prompt_part1, build_compatibility_prompt_part2),
+        pdf_field="compatibility_pdf_url",
+        file_id_field="compatibility_pdf_file_id",
+        filename="Compatibility_Report.pdf",
+        caption="Всё предсказал, как мог. Остальное — к звёздам (или к психотерапевту).",
+        txt_name="compatibility.txt",
+        txt_caption="Совместимость готова, но PDF не прикрепился. Вот полный текст:",
+    ),
+}
+
+def build_report_messages(product_type, user, inputs):
+    part1, part2 = REPORTS[product_type]["prompts"]
+    birth_date = datetime.strptime(user["birth_date"], "%Y-%m-%d").strftime("%d.%m.%Y")
+    if product_type == "compatibility":
+        # Данные партнёра приходят во inputs задачи — их собирает диалог совместимости
+        profile = {
+            "name": user.get("name", "Клиент"),
+            "birth_date": birth_date,
+            "birth_time": user.get("birth_time"),
+            "birth_city": user.get("birth_city"),
+            "birth_country": user.get("birth_country"),
+        }
+        partner = inputs["partner"]
+        return part1(profile, partner), part2(profile, partner)
+
     prompt_args = dict(
         name=user.get("name", "Друг"),
-        date=datetime.strptime(user["birth_date"], "%Y-%m-%d").strftime("%d.%m.%Y"),
+        date=birth_date,
         time_str=user["birth_time"],
         city=user["birth_city"],
         country=user["birth_country"],
     )
-    try:
-        messages1 = build_destiny_prompt_part1(**prompt_args)
-        report_part1 = ask_gpt(
-            messages1,
-            model="gpt-4-turbo",
-            max_tokens=2500,
-            temperature=0.9,
-        )
-        messages2 = build_destiny_prompt_part2(**prompt_args)
-        report_part2 = ask_gpt(
-            messages2,
-            model="gpt-4-turbo",
-            max_tokens=2500,
-            temperature=0.9,
+    return part1(**prompt_args), part2(**prompt_args)
+
+class ReportProgress:
+    # Считает готовые разделы отчёта по заголовкам из pdf_generator, пока GPT пишет текст,
+    # и показывает прогресс в подписи «загрузки» у всех, кто ждёт этот отчёт
+    def __init__(self, bot, job_id, product_type, parts):
+        self.bot = bot
+        self.job_id = job_id
+        self.headers = [h.lower() for h in get_headers_for_product(product_type)]
+        self.texts = [""] * parts
+        self.finished = [False] * parts
+        self.shown = 0
+        self.last_check = 0.0
+        self.task = None
+
+    def completed(self):
+        done = 0
+        for text, finished in zip(self.texts, self.finished):
+            text = text.lower()
+            started = sum(1 for h in self.headers if h in text)
+            # Последний начатый раздел ещё пишется, пока часть не дошла до конца
+            done += started if finished else max(started - 1, 0)
+        return min(done, len(self.headers))
+
+    def update(self, index, text, finished=False):
+        self.texts[index] = text
+        self.finished[index] = self.finished[index] or finished
+        if not self.headers:
+            return
+        # Вызывается на каждый фрагмент потока — весь текст пересчитываем не чаще раза в интервал
+        now = time.monotonic()
+        if now - self.last_check < PROGRESS_EDIT_INTERVAL:
+            return
+        if self.task is not None and not self.task.done():
+            return
+        self.last_check = now
+        done = self.completed()
+        if done == self.shown:
+            return
+        self.shown = done
+        self.task = asyncio.create_task(self._edit(done))
+
+    async def close(self):
+        # Текст готов — ждём последнюю правку, чтобы она не пришла после удаления «загрузки»
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def _edit(self, done):
+        total = len(self.headers)
+        caption = (
+            f"⏳ Кот-астролог пишет твой разбор: готово {done} из {total} разделов\n"
+            + "▰" * done + "▱" * (total - done)
         )
-        report_text = report_part1.strip() + "\n\n" + report_part2.strip()
-    except Exception as e:
-        print("GPT error:", e)
+        for target in report_queue.targets(self.job_id):
+            if not target.get("loading_message_id"):
+                continue
+            try:
+                await self.bot.edit_message_caption(
+                    chat_id=target["chat_id"], message_id=target["loading_message_id"], caption=caption
+                )
+            except Exception as e:
+                print("Progress caption edit error:", e)
+
+async def _delete_loading(bot, target):
+    message_id = target.get("loading_message_id")
+    if not message_id:
         return
+    try:
+        await bot.delete_message(chat_id=target["chat_id"], message_id=message_id)
+    except Exception as e:
+        print("Loading message delete error:", e)
+
+async def _settle_targets(bot, job_id):
+    # Забираем получателей задачи и убираем их «загрузки». Один и тот же чат мог
+    # нажать кнопку несколько раз — отчёт в него отправим один раз.
+    targets = report_queue.seal(job_id)
+    await asyncio.gather(*(_delete_loading(bot, target) for target in targets))
+    return list(dict.fromkeys(target["chat_id"] for target in targets))
 
-    # Генерим PDF
+async def send_report_document(bot, chat_id, product_type, user, document=None, caption=None):
+    # Готовый отчёт шлём по file_id — Telegram не скачивает файл из storage заново.
+    # document — свежий PDF (байты из рендера или ссылка): тогда старый file_id не используем.
+    if tracing.current_trace_id() is not None:
+        return await _send_report_document(bot, chat_id, product_type, user, document, caption)
+    # Вызов из обработчика кнопки: пользователь забирает отчёт, сделанный предгенерацией
+    # после оплаты, — пишем доставку в трассу этого заказа
     try:
-        pdf_bytes = text_to_pdf(report_text)
-        public_url = upload_pdf_to_storage(user["id"], pdf_bytes)
+        trace_id = report_queue.last_trace_id(user["tg_id"], product_type)
     except Exception as e:
-        print("PDF/upload error:", e)
-        public_url = None
+        print("Trace lookup error:", e)
+        trace_id = None
+    with tracing.trace(trace_id), tracing.span("delivery", tg_id=user["tg_id"], product=product_type):
+        return await _send_report_document(bot, chat_id, product_type, user, document, caption)
+
+async def _send_report_document(bot, chat_id, product_type, user, document, caption):
+    report = REPORTS[product_type]
+    caption = caption or report["caption"]
+    file_id = user.get(report["file_id_field"])
+    if file_id and document is None:
+        try:
+            with _stage("telegram_send", product_type, chat_id=chat_id, by="file_id"):
+                return await bot.send_document(chat_id=chat_id, document=file_id, caption=caption)
+        except BadRequest as e:
+            print("Stored file_id rejected, sending by URL:", e)
 
-    # Отправляем текст "мяу приступаю к разгадыванию..." + PDF
     try:
-        await application.bot.send_message(
-            chat_id=tg_id,
-            text=(
-                "Мяу! Приступаю к разгадыванию твоей звёздной судьбы — буду колдовать над натальной картой лично, лапой на сердце!\n"
-                "Это не очередной шаблон с балкона — всё строго по твоим данным, как и полагается уважающему себя коту-астрологу.\n"
-                "Наберись терпения, займёт пару минут... А пока налей себе молока (или, на крайний случай, чаю), расслабь хвост и помурлыкай о чём-нибудь хорошем. Скоро вернусь с результатами!"
-            ),
-        )
-        if public_url:
-            await application.bot.send_document(
-                chat_id=tg_id,
-                document=public_url,
-                filename="Karta_Prednaznacheniya.pdf",
-                caption=(
-                    "Мяу, миссия выполнена! Вот твоя личная натальная карта — не сырая копия из интернета, а настоящий кото-разбор с характером.\n"
-                    "Здесь ты найдёшь подсказки, куда стоит направить свои когти, в чём твои сильные стороны и каких ловушек судьбы лучше избегать.\n\n"
-                    "Изучи внимательно, мурлыкни благодарность звёздам и помни — даже самая мудрая кошка иногда промахивается, но всегда падает на лапы. Вперёд к своему предназначению!"
-                ),
+        with _stage("telegram_send", product_type, chat_id=chat_id):
+            sent = await bot.send_document(
+                chat_id=chat_id,
+                document=document or user[report["pdf_field"]],
+                filename=report["filename"],
+                caption=caption,
             )
-        else:
-            await application.bot.send_message(
-                chat_id=tg_id,
-                text="Карта готова, но файл не прикрепился 😔. Вот текст:\n\n" + report_text,
+    except Exception:
+        metrics.FAILURES.inc(stage="telegram_send", product=product_type)
+        raise
+    try:
+        await users_repo.set_pdf_file_id(user["tg_id"], product_type, sent.document.file_id)
+    except Exception as e:
+        print("file_id save error:", e)
+    return sent
+
+async def _deliver_report(bot, chat_id, product_type, user, document=None):
+    sent = await send_report_document(bot, chat_id, product_type, user, document=document)
+    await asyncio.sleep(2)
+    await bot.send_message(
+        chat_id=chat_id,
+        text="Захочешь посмотреть другие кото-разборы — возвращайся в главное меню. Я тут, если что, не сплю!",
+        reply_markup=ReplyKeyboardMarkup([["В главное меню"]], resize_keyboard=True, is_persistent=True),
+    )
+    return sent
+
+async def _deliver_to_chats(bot, chat_ids, product_type, user, document=None):
+    if not chat_ids:
+        return
+    # Первый чат получает сам файл, остальные — по уже выданному Telegram file_id
+    first, *rest = chat_ids
+    sent = await _deliver_report(bot, first, product_type, user, document=document)
+    if rest:
+        user = {**user, REPORTS[product_type]["file_id_field"]: sent.document.file_id}
+        await asyncio.gather(*(_deliver_report(bot, chat_id, product_type, user) for chat_id in rest))
+
+async def _archive_pdf(tg_id, product_type, pdf_bytes):
+    stage = "upload"
+    try:
+        with _stage(stage, product_type):
+            public_url = await storage.upload_pdf(pdf_bytes)
+        stage = "update_user"
+        with _stage(stage, product_type):
+            await users_repo.set_pdf_url(tg_id, product_type, public_url)
+    except Exception:
+        metrics.FAILURES.inc(stage=stage, product=product_type)
+        raise
+    return public_url
+
+async def _notify_failure(bot, job_id):
+    # Отчёта не будет — убираем «загрузку» у всех, кто ждёт, и говорим об ошибке
+    try:
+        for chat_id in await _settle_targets(bot, job_id):
+            await bot.send_message(chat_id=chat_id, text="Ошибка генерации. Попробуй позже.")
+    except Exception as e:
+        print("Failure notify error:", e)
+
+async def generate_and_send(application, job):
+    # Любой сбой до раздачи отчёта (Supabase, профиль без даты рождения, GPT) — ожидающим
+    # отправляем ошибку. Уже получившие отчёт чаты в задаче не остаются, им ничего не придёт
+    try:
+        await _generate_and_send(application, job)
+    except Exception:
+        await _notify_failure(application.bot, job["id"])
+        raise
+
+async def _generate_and_send(application, job):
+    tg_id, product_type, inputs = job["tg_id"], job["product_type"], job["inputs"]
+    report = REPORTS[product_type]
+    bot = application.bot
+
+    # Задача могла прийти из webhook — читаем строку мимо кэша, чтобы увидеть свежие *_pdf_url
+    user = await users_repo.get_report_context(tg_id, product_type, fresh=True)
+    if not user:
+        await _settle_targets(bot, job["id"])
+        return
+
+    # Отчёт уже готов (например, его успела сделать предгенерация) — не платим за GPT второй раз
+    if user.get(report["pdf_field"]):
+        metrics.CACHE_HITS.inc(cache="pdf", product=product_type)
+        chat_ids = await _settle_targets(bot, job["id"])
+        await _deliver_to_chats(bot, chat_ids, product_type, user)
+        return
+
+    with _stage("prompt_build", product_type):
+        messages_parts = build_report_messages(product_type, user, inputs)
+    # Текст мог остаться от попытки, на которой упал PDF или загрузка — тогда начинаем с рендера
+    report_text = report_store.load(tg_id, product_type, messages_parts)
+    if report_text is not None:
+        metrics.CACHE_HITS.inc(cache="report_text", product=product_type)
+        print(f"Resuming {product_type} report for tg_id={tg_id} from stored text")
+    else:
+        progress = ReportProgress(bot, job["id"], product_type, len(messages_parts))
+        # Повторная генерация (сменились данные, потерялся PDF) уступает лимиты OpenAI первым
+        priority = PRIORITY_LOW if report_store.exists(tg_id, product_type) else PRIORITY_HIGH
+        # Части, готовые на прошлой попытке, повторно не запрашиваем
+        parts = report_store.load_parts(tg_id, product_type, messages_parts)
+        for i, part in enumerate(parts or ()):
+            if part is not None:
+                progress.update(i, part, finished=True)
+        try:
+            report_text = await generate_report_text(
+                *messages_parts,
+                parts=parts,
+                product_type=product_type,
+                cache=llm_cache.enabled_for(product_type),
+                on_progress=progress.update,
+                priority=priority,
             )
+        except Exception as e:
+            await progress.close()
+            print("GPT error:", e)
+            if isinstance(e, ReportGenerationError) and any(part is not None for part in e.parts):
+                try:
+                    report_store.save_parts(tg_id, product_type, messages_parts, e.parts)
+                except Exception as save_error:
+                    print("Report parts save error:", save_error)
+            raise
+        await progress.close()
+        try:
+            report_store.save(tg_id, product_type, messages_parts, report_text)
+            report_store.clear_parts(tg_id, product_type)
+        except Exception as e:
+            print("Report text save error:", e)
+
+    try:
+        with _stage("render", product_type):
+            pdf_bytes = await render_pdf(report_text, product_type=product_type)
     except Exception as e:
-        print("Telegram send error:", e)
\ No newline at end of file
+        metrics.FAILURES.inc(stage="render", product=product_type)
+        print("PDF render error:", e)
+        chat_ids = await _settle_targets(bot, job["id"])
+        # Предгенерация без получателей — пусть задача упадёт и останется в статистике
+        if not chat_ids:
+            raise
+        for chat_id in chat_ids:
+            text_io = BytesIO(report_text.encode("utf-8"))
+            text_io.name = report["txt_name"]
+            await bot.send_document(
+                chat_id=chat_id,
+                document=text_io,
+                filename=report["txt_name"],
+                caption=report["txt_caption"],
+            )
+        return
+
+    # В чат PDF уходит прямо из памяти, архив в storage загружается параллельно.
+    # Если архив не удался, *_pdf_url останется пустым и следующий запрос
+    # перерендерит PDF из сохранённого текста.
+    archive = asyncio.create_task(_archive_pdf(tg_id, product_type, pdf_bytes))
+    chat_ids = await _settle_targets(bot, job["id"])
+    try:
+        await _deliver_to_chats(bot, chat_ids, product_type, user, document=pdf_bytes)
+    finally:
+        await archive
+
+async def run_job(application, job):
+    # Точка входа для воркеров report_queue
+    product_type = job["product_type"]
+    try:
+        with metrics.STAGE_SECONDS.time(stage="total", product=product_type):
+            await generate_and_send(application, job)
+    except Exception:
+        metrics.FAILURES.inc(stage="job", product=product_type)
+        raise
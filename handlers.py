@@ -7,14 +7,13 @@ from telegram.ext import (
 )
 from datetime import datetime
 import asyncio
-import os
 
-from stripe_client import create_checkout_session
+from stripe_client import get_checkout_url
 
-from pdf_generator import text_to_pdf, upload_pdf_to_storage
-from prompts import build_destiny_prompt_part1, build_destiny_prompt_part2, build_solyar_prompt_part1, build_solyar_prompt_part2, build_income_prompt_part1, build_income_prompt_part2, build_compatibility_prompt_part1, build_compatibility_prompt_part2
-from openai_client import ask_gpt
-from supabase_client import get_user, create_user, update_user
+from report_queue import enqueue as enqueue_report
+from generation import send_report_document
+import media
+import users_repo
 
 READY, DATE, TIME, LOCATION = range(4)
 
@@ -24,13 +23,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     name = user.first_name
 
     # ensure user row exists
-    if not get_user(tg_id):
-        create_user(tg_id, name)
+    if await users_repo.get_profile(tg_id) is None:
+        await users_repo.create_user(tg_id, name)
 
-    static_path = os.path.join(os.path.dirname(__file__), "static")
-    animation_path = os.path.join(static_path, "cat_intro.mp4")
-    await update.message.reply_animation(
-        animation=open(animation_path, "rb"),
+    await media.reply_animation(
+        update.message, "cat_intro.mp4",
         caption=(
             "Мяу, ты на территории звёзд и котов! Я — АстроКот, твой персональный проводник по созвездиям и жизненным зигзагам. 🐾\n"
             "Не просто кот, а чёрный, как забытый пакетик валерьянки на антресолях. И да, умею читать натальные карты лучше, чем меню в рыбном ресторане.\n"
@@ -93,7 +90,7 @@ async def save_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     country, city = parts[0], parts[1]
     user = update.effective_user
-    update_user(
+    await users_repo.update_profile(
         user.id,
         birth_date=str(context.user_data["birth_date"]),
         birth_time=context.user_data["birth_time"].strftime("%H:%M"),
@@ -201,8 +198,6 @@ async def compatibility_product(update, context):
     )
 
 async def destiny_card_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    from prompts import build_destiny_prompt_part1, build_destiny_prompt_part2
-    from supabase_client import update_user
 
     # Определяем тип события
     if update.callback_query is not None:
@@ -217,25 +212,20 @@ async def destiny_card_callback(update: Update, context: ContextTypes.DEFAULT_TY
 
     print("CALLBACK TRIGGERED SECOND", flush=True)
 
-    user_list = get_user(tg_id)
-    if not user_list:
+    user = await users_repo.get_entitlements(tg_id, "destiny")
+    if not user:
         await message.reply_text("Не найден профиль. Пройди /start.")
         return
 
-    user = user_list[0]
+    # Оплату мог отметить webhook, а в кэше ещё старая строка — перед пейволом читаем мимо кэша
+    if not user.get("paid_destiny"):
+        user = await users_repo.get_entitlements(tg_id, "destiny", fresh=True)
 
     # --- ЕСЛИ ПРОДУКТ ОПЛАЧЕН ---
     if user.get("paid_destiny"):
         # Если есть сохранённая ссылка на PDF — присылаем тот же файл!
         if user.get("destiny_pdf_url"):
-            await message.reply_document(
-                document=user["destiny_pdf_url"],
-                filename="Karta_Prednaznacheniya.pdf",
-                caption=(
-                    "Мяу, миссия выполнена! Вот твоя личная натальная карта — не сырая копия из интернета, а настоящий кото-разбор с характером.\n"
-                    "Изучи внимательно, мурлыкни благодарность звёздам и помни — даже самая мудрая кошка иногда промахивается, но всегда падает на лапы. Вперёд к своему предназначению!"
-                ),
-            )
+            await send_report_document(context.bot, message.chat_id, "destiny", user)
             await asyncio.sleep(2)
             await message.reply_text(
                 "Захочешь посмотреть другие кото-разборы — возвращайся в главное меню. Я тут, если что, не сплю!",
@@ -249,67 +239,19 @@ async def destiny_card_callback(update: Update, context: ContextTypes.DEFAULT_TY
             "Это не очередной шаблон с балкона — всё строго по твоим данным, как и полагается уважающему себя коту-астрологу.\n"
             "Наберись терпения, займёт пару минут... А пока налей себе молока (или, на крайний случай, чаю), расслабь хвост и помурлыкай о чём-нибудь хорошем. Скоро вернусь с результатами!"
         )
-        loading_msg = await message.reply_animation(
-            animation=open("static/loading_cat2.gif", "rb"),
+        loading_msg = await media.reply_animation(
+            message, "loading_cat2.gif",
             caption="⏳ Готовлю твой годовой путь... Сейчас будет волшебство!"
 )
 
-        prompt_args = dict(
-            name=user.get("name", "Друг"),
-            date=datetime.strptime(user["birth_date"], "%Y-%m-%d").strftime("%d.%m.%Y"),
-            time_str=user["birth_time"],
-            city=user["birth_city"],
-            country=user["birth_country"],
-        )
-        try:
-            messages1 = build_destiny_prompt_part1(**prompt_args)
-            report_part1 = ask_gpt(messages1, model="gpt-4-turbo", max_tokens=2500, temperature=0.9)
-            messages2 = build_destiny_prompt_part2(**prompt_args)
-            report_part2 = ask_gpt(messages2, model="gpt-4-turbo", max_tokens=2500, temperature=0.9)
-            report_text = report_part1.strip() + "\n\n" + report_part2.strip()
-        except Exception as e:
-            print("GPT error:", e)
-            await loading_msg.delete()
-            await message.reply_text("Ошибка генерации. Попробуй позже.")
-            return
-
-        try:
-            pdf_bytes = text_to_pdf(report_text)
-            public_url = upload_pdf_to_storage(user["id"], pdf_bytes)
-            # Сохраняем ссылку в базе
-            update_user(user["tg_id"], destiny_pdf_url=public_url)
-            await loading_msg.delete()
-            await message.reply_document(
-                document=public_url,
-                filename="Karta_Prednaznacheniya.pdf",
-                caption=(
-                    "Мяу, миссия выполнена! Вот твоя личная натальная карта — не сырая копия из интернета, а настоящий кото-разбор с характером.\n"
-                    "Изучи внимательно, мурлыкни благодарность звёздам и помни — даже самая мудрая кошка иногда промахивается, но всегда падает на лапы. Вперёд к своему предназначению!"
-                ),
-            )
-            await asyncio.sleep(2)
-            await message.reply_text(
-                "Захочешь посмотреть другие кото-разборы — возвращайся в главное меню. Я тут, если что, не сплю!",
-                reply_markup=ReplyKeyboardMarkup([["В главное меню"]], resize_keyboard=True,is_persistent=True)
-            )
-        except Exception as e:
-            print("PDF/upload error:", e)
-            await loading_msg.delete()
-            from io import BytesIO
-            text_io = BytesIO(report_text.encode("utf-8"))
-            text_io.name = "destiny.txt"
-            text_io.seek(0)
-            await message.reply_document(
-                document=text_io,
-                filename="destiny.txt",
-                caption="Карта готова, но PDF не прикрепился. Вот текст:"
-            )
+        # Генерация идёт в фоне (report_queue), PDF пришлёт воркер
+        enqueue_report(tg_id, "destiny", target={"chat_id": message.chat_id, "loading_message_id": loading_msg.message_id})
         return
 
     # --- ЕСЛИ ПРОДУКТ НЕ ОПЛАЧЕН ---
     success_url = "https://t.me/CosmoAstrologyBot"
     cancel_url = "https://t.me/CosmoAstrologyBot"
-    checkout_url = create_checkout_session(tg_id, "destiny", success_url, cancel_url)
+    checkout_url = await get_checkout_url(tg_id, "destiny", success_url, cancel_url)
 
     await message.reply_text(
         "Стоимость: 4.99€. Чтобы увидеть свой звёздный путь — поддержи кота-астролога парой монет на консерву! Ссылка для оплаты ниже 👇",
@@ -324,8 +266,6 @@ async def destiny_card_callback(update: Update, context: ContextTypes.DEFAULT_TY
     )
 
 async def solyar_card_callback(update, context):
-    from prompts import build_solyar_prompt_part1, build_solyar_prompt_part2
-    from supabase_client import update_user
 
     if update.callback_query is not None:
         query = update.callback_query
@@ -337,18 +277,19 @@ async def solyar_card_callback(update, context):
         tg_id = update.effective_user.id
         message = update.message
 
-    user_list = get_user(tg_id)
-    if not user_list:
+    user = await users_repo.get_entitlements(tg_id, "solyar")
+    if not user:
         await message.reply_text("Не найден профиль. Пройди /start.")
         return
 
-    user = user_list[0]
+    # Оплату мог отметить webhook, а в кэше ещё старая строка — перед пейволом читаем мимо кэша
+    if not user.get("paid_solyar"):
+        user = await users_repo.get_entitlements(tg_id, "solyar", fresh=True)
 
     # Если куплен и есть ссылка — сразу отдаём PDF
     if user.get("paid_solyar") and user.get("solyar_pdf_url"):
-        await message.reply_document(
-            document=user["solyar_pdf_url"],
-            filename="Solyar_Report.pdf",
+        await send_report_document(
+            context.bot, message.chat_id, "solyar", user,
             caption=(
                 "Мяу, всё готово! Вот твой личный прогноз на год — разбор от АстроКотского. Изучи внимательно, найди сильные и сложные периоды, и помни: твой год — это территория для свершений.\n"
                 "Если тебе вдруг станет скучно — можешь перечитать этот разбор. Хотя, между нами, я бы лучше поспал."
@@ -366,64 +307,18 @@ async def solyar_card_callback(update, context):
             "Мяу! Я начинаю собирать твой годовой путь — это не просто прогноз, а твой личный астрологический навигатор на ближайший год. Хвостиком чувствую: получится что-то особенное!"
         )
         
-        loading_msg = await message.reply_video(
-            video=open("static/loading_cat.mp4", "rb"),
+        loading_msg = await media.reply_video(
+            message, "loading_cat.mp4",
             caption="⏳ Обрабатываю твой годовой путь... Подожди минутку, кот-астролог колдует над звёздами!"
         )
 
-        prompt_args = dict(
-            name=user.get("name", "Друг"),
-            date=datetime.strptime(user["birth_date"], "%Y-%m-%d").strftime("%d.%m.%Y"),
-            time_str=user["birth_time"],
-            city=user["birth_city"],
-            country=user["birth_country"],
-        )
-
-        try:
-            messages1 = build_solyar_prompt_part1(**prompt_args)
-            report_part1 = ask_gpt(messages1, model="gpt-4-turbo", max_tokens=2500, temperature=0.9)
-            messages2 = build_solyar_prompt_part2(**prompt_args)
-            report_part2 = ask_gpt(messages2, model="gpt-4-turbo", max_tokens=2500, temperature=0.9)
-            report_text = report_part1.strip() + "\n\n" + report_part2.strip()
-        except Exception as e:
-            print("GPT error:", e)
-            await loading_msg.delete()
-            await message.reply_text("Ошибка генерации. Попробуй позже.")
-            return
-
-        try:
-            pdf_bytes = text_to_pdf(report_text, product_type="solyar")
-            public_url = upload_pdf_to_storage(user["id"], pdf_bytes)
-            update_user(user["tg_id"], solyar_pdf_url=public_url)
-            await loading_msg.delete()
-            await message.reply_document(
-                document=public_url,
-                filename="Solyar_Report.pdf",
-                caption="Мяу, всё готово! Вот твой личный прогноз на год — разбор от АстроКотского. Изучи внимательно, найди сильные и сложные периоды, и помни: твой год — это территория для свершений."
-            )
-            await asyncio.sleep(2)
-            await message.reply_text(
-                "Захочешь посмотреть другие кото-разборы — возвращайся в главное меню. Я тут, если что, не сплю!",
-                reply_markup=ReplyKeyboardMarkup([["В главное меню"]], resize_keyboard=True,is_persistent=True)
-            )
-        except Exception as e:
-            print("PDF/upload error:", e)
-            await loading_msg.delete()
-            from io import BytesIO
-            text_io = BytesIO(report_text.encode("utf-8"))
-            text_io.name = "solyar.txt"
-            text_io.seek(0)
-            await message.reply_document(
-                document=text_io,
-                filename="solyar.txt",
-                caption="Разбор готов, но PDF не прикрепился. Вот текст:"
-            )
+        enqueue_report(tg_id, "solyar", target={"chat_id": message.chat_id, "loading_message_id": loading_msg.message_id})
         return
 
     # Если не оплачен — предлагай оплатить
     success_url = "https://t.me/CosmoAstrologyBot"
     cancel_url = "https://t.me/CosmoAstrologyBot"
-    checkout_url = create_checkout_session(tg_id, "solyar", success_url, cancel_url)
+    checkout_url = await get_checkout_url(tg_id, "solyar", success_url, cancel_url)
 
     await message.reply_text(
         "Годовой путь — Стоимость: 4.99€. Поддержи кота-астролога парой монет и получи персональный навигатор по твоему году. Оплата ниже 👇",
@@ -434,8 +329,6 @@ async def solyar_card_callback(update, context):
     )
 
 async def income_card_callback(update, context):
-    from prompts import build_income_prompt_part1, build_income_prompt_part2
-    from supabase_client import update_user
 
     if update.callback_query is not None:
         query = update.callback_query
@@ -447,20 +340,18 @@ async def income_card_callback(update, context):
         tg_id = update.effective_user.id
         message = update.message
 
-    user_list = get_user(tg_id)
-    if not user_list:
+    user = await users_repo.get_entitlements(tg_id, "income")
+    if not user:
         await message.reply_text("Не найден профиль. Пройди /start.")
         return
 
-    user = user_list[0]
+    # Оплату мог отметить webhook, а в кэше ещё старая строка — перед пейволом читаем мимо кэша
+    if not user.get("paid_income"):
+        user = await users_repo.get_entitlements(tg_id, "income", fresh=True)
 
     # Если куплен и есть ссылка — сразу отдаём PDF
     if user.get("paid_income") and user.get("income_pdf_url"):
-        await message.reply_document(
-            document=user["income_pdf_url"],
-            filename="Income_Report.pdf",
-            caption="Вот твой астрологический разбор по деньгам и карьере! Тут написано всё, что нужно. Если что не так — кидай валерьянку, буду думать ещё."
-        )
+        await send_report_document(context.bot, message.chat_id, "income", user)
         await asyncio.sleep(2)
         await message.reply_text(
             "Захочешь посмотреть другие кото-разборы — возвращайся в главное меню. Я тут, если что, не сплю!",
@@ -472,64 +363,18 @@ async def income_card_callback(update, context):
         await message.reply_text(
             "Мяу! Делаю разбор по деньгам и карьере. Хвостом чую: сейчас тебе откроются новые горизонты!"
         )
-        loading_msg = await message.reply_animation(
-            animation=open("static/loading_cat2.gif", "rb"),
+        loading_msg = await media.reply_animation(
+            message, "loading_cat2.gif",
             caption="⏳ Готовлю твой годовой путь... Сейчас будет волшебство!"
             )
 
-        prompt_args = dict(
-            name=user.get("name", "Друг"),
-            date=datetime.strptime(user["birth_date"], "%Y-%m-%d").strftime("%d.%m.%Y"),
-            time_str=user["birth_time"],
-            city=user["birth_city"],
-            country=user["birth_country"],
-        )
-
-        try:
-            messages1 = build_income_prompt_part1(**prompt_args)
-            report_part1 = ask_gpt(messages1, model="gpt-4-turbo", max_tokens=2500, temperature=0.9)
-            messages2 = build_income_prompt_part2(**prompt_args)
-            report_part2 = ask_gpt(messages2, model="gpt-4-turbo", max_tokens=2500, temperature=0.9)
-            report_text = report_part1.strip() + "\n\n" + report_part2.strip()
-        except Exception as e:
-            print("GPT error:", e)
-            await loading_msg.delete()
-            await message.reply_text("Ошибка генерации. Попробуй позже.")
-            return
-
-        try:
-            pdf_bytes = text_to_pdf(report_text, product_type="income")
-            public_url = upload_pdf_to_storage(user["id"], pdf_bytes)
-            update_user(user["tg_id"], income_pdf_url=public_url)
-            await loading_msg.delete()
-            await message.reply_document(
-                document=public_url,
-                filename="Income_Report.pdf",
-                caption="Вот твой астрологический разбор по деньгам и карьере! Тут написано всё, что нужно. Если что не так — кидай валерьянку, буду думать ещё."
-            )
-            await asyncio.sleep(2)
-            await message.reply_text(
-                "Захочешь посмотреть другие кото-разборы — возвращайся в главное меню. Я тут, если что, не сплю!",
-                reply_markup=ReplyKeyboardMarkup([["В главное меню"]], resize_keyboard=True,is_persistent=True)
-            )
-        except Exception as e:
-            print("PDF/upload error:", e)
-            await loading_msg.delete()
-            from io import BytesIO
-            text_io = BytesIO(report_text.encode("utf-8"))
-            text_io.name = "income.txt"
-            text_io.seek(0)
-            await message.reply_document(
-                document=text_io,
-                filename="income.txt",
-                caption="Разбор готов, но PDF не прикрепился. Вот текст:"
-            )
+        enqueue_report(tg_id, "income", target={"chat_id": message.chat_id, "loading_message_id": loading_msg.message_id})
         return
 
     # Если не оплачен — предлагай оплатить
     success_url = "https://t.me/CosmoAstrologyBot"
     cancel_url = "https://t.me/CosmoAstrologyBot"
-    checkout_url = create_checkout_session(tg_id, "income", success_url, cancel_url)
+    checkout_url = await get_checkout_url(tg_id, "income", success_url, cancel_url)
 
     await message.reply_text(
         "Карьерный разбор — Стоимость: 4.99€. Поддержи кота-астролога и получи свой персональный денежный разбор! Оплата ниже 👇",
@@ -589,15 +434,13 @@ async def get_partner_location(update, context):
 
 async def compatibility_card_callback(update, context):
     user_tg = update.effective_user
-    user_db = get_user(user_tg.id)[0]
+    user_db = await users_repo.get_entitlements(user_tg.id, "compatibility")
+    if not user_db.get("paid_compatibility"):
+        user_db = await users_repo.get_entitlements(user_tg.id, "compatibility", fresh=True)
 
     # 1. Если оплачен и есть готовый PDF — сразу присылаем!
     if user_db.get("paid_compatibility") and user_db.get("compatibility_pdf_url"):
-        await update.message.reply_document(
-            document=user_db["compatibility_pdf_url"],
-            filename="Compatibility_Report.pdf",
-            caption="Всё предсказал, как мог. Остальное — к звёздам (или к психотерапевту)."
-        )
+        await send_report_document(context.bot, update.message.chat_id, "compatibility", user_db)
         await asyncio.sleep(2)
         await main_menu(update, context)
         return ConversationHandler.END
@@ -606,7 +449,7 @@ async def compatibility_card_callback(update, context):
     if not user_db.get("paid_compatibility"):
         success_url = "https://t.me/CosmoAstrologyBot"
         cancel_url = "https://t.me/CosmoAstrologyBot"
-        checkout_url = create_checkout_session(user_tg.id, "compatibility", success_url, cancel_url)
+        checkout_url = await get_checkout_url(user_tg.id, "compatibility", success_url, cancel_url)
         await update.message.reply_text(
             "Стоимость: 4.99€. Поддержи кота-астролога и получи разбор совместимости по дате рождения! Оплата ниже 👇",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💳 Оплатить в Stripe", url=checkout_url)]])
@@ -629,19 +472,13 @@ async def compatibility_card_callback(update, context):
 
 async def generate_compatibility_pdf(update, context):
     user_tg = update.effective_user
-    user_db = get_user(user_tg.id)[0]
-
-    user = {
-        "name": user_db.get("name", "Клиент"),
-        "birth_date": datetime.strptime(user_db["birth_date"], "%Y-%m-%d").strftime("%d.%m.%Y"),
-        "birth_time": user_db.get("birth_time"),
-        "birth_city": user_db.get("birth_city"),
-        "birth_country": user_db.get("birth_country"),
-    }
+
+    # Данные партнёра сохраняем в задачу — генерация идёт в фоне (report_queue)
+    birth_time = context.user_data.get("partner_birth_time")
     partner = {
         "name": context.user_data.get("partner_name", "Партнёр"),
         "birth_date": context.user_data.get("partner_birth_date").strftime("%d.%m.%Y"),
-        "birth_time": context.user_data.get("partner_birth_time"),
+        "birth_time": birth_time.strftime("%H:%M") if birth_time else None,
         "birth_city": context.user_data.get("partner_city"),
         "birth_country": context.user_data.get("partner_country"),
     }
@@ -649,47 +486,14 @@ async def generate_compatibility_pdf(update, context):
     await update.message.reply_text(
         "Мяу! Начинаю разбор совместимости. Лапы чешутся узнать всё про ваши звёзды — жди подробный PDF!"
     )
-    loading_msg = await update.message.reply_video(
-        video=open("static/loading_cat.mp4", "rb"),
+    loading_msg = await media.reply_video(
+        update.message, "loading_cat.mp4",
         caption="⏳ Обрабатываю твою совместимость с партнёром... Подожди минутку, кот-астролог колдует над звёздами!"
     )
 
-    try:
-        messages1 = build_compatibility_prompt_part1(user, partner)
-        report_part1 = ask_gpt(messages1, model="gpt-4-turbo", max_tokens=2500, temperature=0.9)
-        messages2 = build_compatibility_prompt_part2(user, partner)
-        report_part2 = ask_gpt(messages2, model="gpt-4-turbo", max_tokens=2500, temperature=0.9)
-        report_text = report_part1.strip() + "\n\n" + report_part2.strip()
-    except Exception as e:
-        print("GPT error:", e)
-        await loading_msg.delete()
-        await update.message.reply_text("Ошибка генерации. Попробуй позже.")
-        return
-
-    try:
-        pdf_bytes = text_to_pdf(report_text, product_type="compatibility")
-        public_url = upload_pdf_to_storage(user_db["id"], pdf_bytes)
-        update_user(user_db["tg_id"], compatibility_pdf_url=public_url)
-        await loading_msg.delete()
-        await update.message.reply_document(
-            document=public_url,
-            filename="Compatibility_Report.pdf",
-            caption="Всё предсказал, как мог. Остальное — к звёздам (или к психотерапевту)."
-        )
-        await asyncio.sleep(2)
-        await update.message.reply_text(
-            "Захочешь получить другие кото-разборы — возвращайся в главное меню. Я тут, если что, не сплю!",
-            reply_markup=ReplyKeyboardMarkup([["В главное меню"]], resize_keyboard=True,is_persistent=True)
-)
-    except Exception as e:
-        print("PDF/upload error:", e)
-        await loading_msg.delete()
-        from io import BytesIO
-        text_io = BytesIO(report_text.encode("utf-8"))
-        text_io.name = "compatibility.txt"
-        text_io.seek(0)
-        await update.message.reply_document(
-            document=text_io,
-            filename="compatibility.txt",
-            caption="Совместимость готова, но PDF не прикрепился. Вот полный текст:"
-        )
\ No newline at end of file
+    enqueue_report(
+        user_tg.id,
+        "compatibility",
+        {"partner": partner},
+        target={"chat_id": update.message.chat_id, "loading_message_id": loading_msg.message_id},
+    )
@@ -0,0 +1,113 @@
+# llm_cache.py
+# Дисковый кэш ответов GPT. Ключ — sha256 от модели, сообщений и параметров запроса,
+# значение — сжатый zlib текст ответа. Промпты детерминированы (имя, дата, время, место),
+# поэтому повторная генерация после ошибки PDF/загрузки не оплачивается второй раз.
+
+import os
+import json
+import zlib
+import hashlib
+import threading
+
+LLM_CACHE_DIR = os.getenv(
+    "LLM_CACHE_DIR",
+    os.path.join(os.path.dirname(__file__), "data", "llm_cache"),
+)
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "200"))
+# Продукты, для которых кэш не используется, через запятую: например "compatibility"
+LLM_CACHE_DISABLED_FOR = {
+    p.strip() for p in os.getenv("LLM_CACHE_DISABLED_FOR", "").split(",") if p.strip()
+}
+
+_lock = threading.Lock()
+_total_bytes = None
+_counters = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+def enabled_for(product_type):
+    return LLM_CACHE_MAX_MB > 0 and product_type not in LLM_CACHE_DISABLED_FOR
+
+def make_key(model, messages, **params):
+    raw = json.dumps(
+        {"model": model, "messages": messages, "params": params},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _path(key):
+    return os.path.join(LLM_CACHE_DIR, key[:2], f"{key}.z")
+
+def _entries():
+    for root, _, files in os.walk(LLM_CACHE_DIR):
+        for name in files:
+            if name.endswith(".z"):
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+def get(key):
+    path = _path(key)
+    try:
+        with open(path, "rb") as f:
+            text = zlib.decompress(f.read()).decode("utf-8")
+    except (FileNotFoundError, zlib.error):
+        _counters["misses"] += 1
+        return None
+    # mtime — время последнего использования, по нему вытесняем
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    _counters["hits"] += 1
+    return text
+
+def put(key, text):
+    global _total_bytes
+    data = zlib.compress(text.encode("utf-8"), 6)
+    path = _path(key)
+    # Ошибка диска не должна стоить уже оплаченного ответа — просто не кэшируем
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print("[LLM_CACHE] write error:", e)
+        return
+    _counters["writes"] += 1
+
+    with _lock:
+        if _total_bytes is None:
+            _total_bytes = sum(size for _, size, _ in _entries())
+        else:
+            _total_bytes += len(data)
+        if _total_bytes > LLM_CACHE_MAX_MB * 1024 * 1024:
+            _evict()
+
+def _evict():
+    # Удаляем давно не использованные ответы, пока не освободим 10% лимита
+    global _total_bytes
+    limit = LLM_CACHE_MAX_MB * 1024 * 1024 * 0.9
+    entries = sorted(_entries())
+    _total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if _total_bytes <= limit:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        _total_bytes -= size
+        _counters["evictions"] += 1
+
+def stats():
+    total = _counters["hits"] + _counters["misses"]
+    return {
+        **_counters,
+        "bytes": _total_bytes,
+        "hit_rate": _counters["hits"] / total if total else None,
+    }
@@ -0,0 +1,74 @@
+# media.py
+# Реестр статических анимаций/видео: каждый файл из static/ загружается в Telegram
+# один раз, дальше шлём его по file_id. Ключ — хэш содержимого, так что замена
+# файла в static/ автоматически приводит к новой загрузке.
+
+import os
+import json
+import hashlib
+from telegram.error import BadRequest
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+MEDIA_CACHE_PATH = os.getenv(
+    "MEDIA_CACHE_PATH",
+    os.path.join(os.path.dirname(__file__), "data", "media_file_ids.json"),
+)
+
+_file_ids = None
+_hashes = {}
+
+def _load():
+    global _file_ids
+    if _file_ids is None:
+        try:
+            with open(MEDIA_CACHE_PATH, encoding="utf-8") as f:
+                _file_ids = json.load(f)
+        except (FileNotFoundError, ValueError):
+            _file_ids = {}
+    return _file_ids
+
+def _save():
+    os.makedirs(os.path.dirname(MEDIA_CACHE_PATH), exist_ok=True)
+    tmp_path = MEDIA_CACHE_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(_file_ids, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, MEDIA_CACHE_PATH)
+
+def _content_hash(path):
+    digest = _hashes.get(path)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        digest = _hashes[path] = sha.hexdigest()
+    return digest
+
+async def _send(message, kind, name, **kwargs):
+    path = os.path.join(STATIC_DIR, name)
+    key = f"{_content_hash(path)}:{kind}"
+    reply = getattr(message, f"reply_{kind}")
+
+    file_id = _load().get(key)
+    if file_id:
+        try:
+            return await reply(**{kind: file_id}, **kwargs)
+        except BadRequest as e:
+            print(f"[MEDIA] cached file_id for {name} rejected, re-uploading:", e)
+            _file_ids.pop(key, None)
+
+    with open(path, "rb") as f:
+        sent = await reply(**{kind: f}, **kwargs)
+    # Telegram может сохранить файл как документ, если не распознал формат
+    media = getattr(sent, kind, None) or sent.document
+    if media is not None:
+        _file_ids[key] = media.file_id
+        _save()
+        print(f"[MEDIA] uploaded {name}, cached file_id")
+    return sent
+
+async def reply_animation(message, name, **kwargs):
+    return await _send(message, "animation", name, **kwargs)
+
+async def reply_video(message, name, **kwargs):
+    return await _send(message, "video", name, **kwargs)
@@ -0,0 +1,208 @@
+# metrics.py
+# Метрики в текстовом формате Prometheus: гистограммы длительности этапов генерации
+# по продуктам, счётчики токенов и ошибок, плюс stats() остальных модулей (кэши, очереди,
+# лимиты OpenAI), которые снимаются в момент запроса /metrics.
+
+import os
+import time
+import asyncio
+import threading
+from contextlib import contextmanager, nullcontext
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Route
+
+# Отдельный /metrics для процесса без своего HTTP-сервера (бот в режиме polling), 0 — не поднимать
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Этапы длятся от миллисекунд (кэш, запись в базу) до минут (GPT)
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120, 180, 300)
+
+_lock = threading.Lock()
+_metrics = []
+_sources = {}
+
+def percentile(values, q):
+    # Для stats() модулей: перцентиль по последним замерам, None — замеров нет
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple((name, labels.get(name, "")) for name in self.labelnames)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with _lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._values = {}
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple((name, labels.get(name, "")) for name in self.labelnames)
+        with _lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        # Работает и вокруг await: меряется реальное время этапа
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    le = key + (("le", _format_value(float(bound))),)
+                    lines.append(f"{self.name}_bucket{_format_labels(le)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {counts[-1]}")
+        return lines
+
+def register_stats(prefix, stats_fn, counters=(), label=None):
+    # stats_fn — любой stats() из модулей бота. Числовые значения становятся
+    # gauge-метриками astrobot_<prefix>_<ключ>, ключи из counters — счётчиками _total.
+    # label: stats_fn возвращает {значение метки: {ключ: число}} (например, по моделям).
+    # Повторная регистрация того же prefix заменяет прежнюю
+    _sources[prefix] = (stats_fn, set(counters), label)
+
+def _render_sources():
+    series = {}
+    for prefix, (stats_fn, counters, label) in _sources.items():
+        try:
+            stats = stats_fn()
+        except Exception as e:
+            print(f"[METRICS] {prefix} stats error:", e)
+            continue
+        groups = stats.items() if label else [(None, stats)]
+        for label_value, values in groups:
+            labels = ((label, label_value),) if label else ()
+            for key, value in values.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue
+                is_counter = key in counters
+                name = f"astrobot_{prefix}_{key}" + ("_total" if is_counter else "")
+                kind = "counter" if is_counter else "gauge"
+                series.setdefault((name, kind), []).append((labels, value))
+
+    lines = []
+    for (name, kind), samples in sorted(series.items()):
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return lines
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    lines.extend(_render_sources())
+    return "\n".join(lines) + "\n"
+
+async def endpoint(request):
+    return Response(render(), media_type=CONTENT_TYPE)
+
+class _MetricsServer(uvicorn.Server):
+    # Сигналы остаются за приложением (run_polling), uvicorn их не перехватывает
+    def capture_signals(self):
+        return nullcontext()
+
+_server = None
+_server_task = None
+
+async def _serve(server):
+    try:
+        await server.serve()
+    except SystemExit:
+        # uvicorn выходит через sys.exit, если порт занят, — бот из-за метрик не падает
+        print(f"[METRICS] failed to serve on port {server.config.port}")
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    global _server, _server_task
+    if not port or _server is not None:
+        return
+    app = Starlette(routes=[Route("/metrics", endpoint)])
+    _server = _MetricsServer(uvicorn.Config(app, host=host, port=port, lifespan="off", ws="none", log_config=None))
+    _server_task = asyncio.create_task(_serve(_server))
+    print(f"[METRICS] serving /metrics on {host}:{port}")
+
+async def stop_server():
+    global _server, _server_task
+    if _server is None:
+        return
+    _server.should_exit = True
+    await _server_task
+    _server, _server_task = None, None
+
+STAGE_SECONDS = Histogram(
+    "astrobot_report_stage_seconds",
+    "Duration of report pipeline stages",
+    ("stage", "product"),
+)
+GPT_TOKENS = Counter(
+    "astrobot_gpt_tokens_total",
+    "OpenAI tokens by report part and direction (in = prompt, out = completion)",
+    ("product", "part", "model", "direction"),
+)
+CACHE_HITS = Counter(
+    "astrobot_cache_hits_total",
+    "Reports served without regeneration (pdf = ready PDF, report_text = stored GPT text)",
+    ("cache", "product"),
+)
+FAILURES = Counter(
+    "astrobot_failures_total",
+    "Failed pipeline stages",
+    ("stage", "product"),
+)
+SUPABASE_SECONDS = Histogram(
+    "astrobot_supabase_request_seconds",
+    "Duration of Supabase REST requests",
+    ("op",),
+)
@@ -0,0 +1,7 @@
+-- Telegram file_id готовых отчётов (доставка без повторной загрузки из storage).
+-- Применить в Supabase SQL editor до или после выкладки: пока колонок нет,
+-- users_repo читает без них и отправляет отчёты по *_pdf_url.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS destiny_pdf_file_id text;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS solyar_pdf_file_id text;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS income_pdf_file_id text;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS compatibility_pdf_file_id text;
@@ -0,0 +1,104 @@
+# model_router.py
+# Какой моделью писать отчёт. У каждого продукта — основная модель и запасные по порядку.
+# openai_client сообщает сюда задержку и исход каждого запроса; если у модели p95 задержки
+# или доля ошибок выходят за SLO, части отчёта уходят на следующую здоровую модель.
+
+import os
+import json
+import time
+import random
+import threading
+from collections import deque
+from metrics import percentile
+
+DEFAULT_ROUTE = {
+    "models": ["gpt-4-turbo", "gpt-4o"],
+    "max_tokens": 2500,
+    "temperature": 0.9,
+}
+# Переопределение в JSON, например {"compatibility": {"models": ["gpt-4o", "gpt-4-turbo"]}}
+MODEL_ROUTES = {
+    product: {**DEFAULT_ROUTE, **override}
+    for product, override in {
+        "destiny": {},
+        "solyar": {},
+        "income": {},
+        "compatibility": {},
+        **json.loads(os.getenv("MODEL_ROUTES", "{}")),
+    }.items()
+}
+# SLO модели: p95 задержки одного запроса (сек) и доля ошибок за окно
+MODEL_LATENCY_SLO = float(os.getenv("MODEL_LATENCY_SLO", "120"))
+MODEL_ERROR_RATE_SLO = float(os.getenv("MODEL_ERROR_RATE_SLO", "0.3"))
+# Статистика за последние MODEL_STATS_WINDOW секунд; меньше MODEL_MIN_SAMPLES замеров — модель считаем здоровой
+MODEL_STATS_WINDOW = float(os.getenv("MODEL_STATS_WINDOW", "600"))
+MODEL_MIN_SAMPLES = int(os.getenv("MODEL_MIN_SAMPLES", "5"))
+# Доля запросов, которая всё равно идёт в деградировавшую основную модель — чтобы заметить восстановление
+MODEL_PROBE_RATE = float(os.getenv("MODEL_PROBE_RATE", "0.05"))
+
+_lock = threading.Lock()
+_samples = {}
+_current = {}
+
+def record(model, latency, ok):
+    with _lock:
+        _samples.setdefault(model, deque(maxlen=500)).append((time.monotonic(), latency, ok))
+
+def model_stats(model):
+    cutoff = time.monotonic() - MODEL_STATS_WINDOW
+    with _lock:
+        samples = _samples.get(model, ())
+        while samples and samples[0][0] < cutoff:
+            samples.popleft()
+        samples = list(samples)
+    latencies = [latency for _, latency, ok in samples if ok]
+    errors = sum(1 for _, _, ok in samples if not ok)
+    return {
+        "count": len(samples),
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "error_rate": errors / len(samples) if samples else None,
+    }
+
+def _healthy(stats):
+    if stats["count"] < MODEL_MIN_SAMPLES:
+        return True
+    if stats["error_rate"] > MODEL_ERROR_RATE_SLO:
+        return False
+    return stats["p95"] is None or stats["p95"] <= MODEL_LATENCY_SLO
+
+def choose(product_type):
+    models = MODEL_ROUTES[product_type]["models"]
+    stats = {model: model_stats(model) for model in models}
+    healthy = [model for model in models if _healthy(stats[model])]
+    if healthy:
+        model = healthy[0]
+    else:
+        # Все за SLO — берём самую быструю (у модели без успешных ответов p95 нет)
+        model = min(
+            models,
+            key=lambda m: stats[m]["p95"] if stats[m]["p95"] is not None else float("inf"),
+        )
+
+    if _current.get(product_type) != model:
+        print(f"[ROUTER] {product_type}: routing to {model} ({stats[model]})")
+        _current[product_type] = model
+    if model != models[0] and random.random() < MODEL_PROBE_RATE:
+        return models[0]
+    return model
+
+def params(product_type):
+    # Аргументы для ask_gpt_async: модель выбирается заново на каждый запрос
+    route = MODEL_ROUTES[product_type]
+    return {
+        "model": choose(product_type),
+        "max_tokens": route["max_tokens"],
+        "temperature": route["temperature"],
+    }
+
+def stats():
+    models = {m for route in MODEL_ROUTES.values() for m in route["models"]}
+    return {
+        "models": {model: model_stats(model) for model in sorted(models)},
+        "routes": dict(_current),
+    }
@@ -1,16 +1,270 @@
 # openai_client.py
 
 import os
-from openai import OpenAI
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+import httpx
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import llm_cache
+import model_router
+import metrics
+import tracing
+from rate_limiter import TokenBucketScheduler, PRIORITY_HIGH
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Таймаут одного запроса к OpenAI (сек) и сколько запросов держим одновременно
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+# Повторы при 429/5xx/таймаутах: экспоненциальная пауза с джиттером, Retry-After важнее.
+# OPENAI_DEADLINE — предел на весь вызов вместе с повторами и ожиданием
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "1"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "30"))
+OPENAI_DEADLINE = float(os.getenv("OPENAI_DEADLINE", "300"))
+# После стольких сбоев подряд перестаём ходить в OpenAI на OPENAI_BREAKER_COOLDOWN секунд
+OPENAI_BREAKER_THRESHOLD = int(os.getenv("OPENAI_BREAKER_THRESHOLD", "5"))
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "30"))
 
-def ask_gpt(messages, model="gpt-4-turbo", max_tokens=2500, temperature=0.9):
-    resp = client.chat.completions.create(
+# Лимиты организации в OpenAI: запросы и токены в минуту (0 — не ограничивать)
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "300000"))
+# Для оценки промпта без токенизатора: русский текст — примерно 2 символа на токен
+OPENAI_CHARS_PER_TOKEN = float(os.getenv("OPENAI_CHARS_PER_TOKEN", "2"))
+
+# Один общий пул соединений на весь процесс — keep-alive между запросами.
+# Повторы SDK выключены: ими управляет _call_with_retries
+async_client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONCURRENCY * 2,
+            max_keepalive_connections=OPENAI_MAX_CONCURRENCY,
+        ),
+    ),
+)
+_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+# Все асинхронные запросы проходят через общий планировщик: OpenAI считает max_tokens
+# в TPM сразу при приёме запроса, поэтому резервируем промпт + max_tokens
+limiter = TokenBucketScheduler(OPENAI_RPM, OPENAI_TPM)
+_counters = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0}
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    # closed — работаем как обычно; open — OpenAI деградировал, сразу отказываем;
+    # half_open — кулдаун прошёл, пропускаем один пробный запрос
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def wait_time(self):
+        # 0 — можно идти в OpenAI, иначе через сколько секунд спросить снова
+        with self._lock:
+            if self.state == "open":
+                remaining = self.opened_at + self.cooldown - time.monotonic()
+                if remaining > 0:
+                    return remaining
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open":
+                if self._probing:
+                    return 1.0
+                self._probing = True
+            return 0
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == "half_open" or self.failures >= self.threshold:
+                if self.state != "open":
+                    self.opens += 1
+                    print(f"[OPENAI] circuit open for {self.cooldown:g}s after {self.failures} failure(s)")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        # Пробный запрос отменили, не дождавшись ответа — даём попробовать другому
+        with self._lock:
+            self._probing = False
+
+breaker = CircuitBreaker(OPENAI_BREAKER_THRESHOLD, OPENAI_BREAKER_COOLDOWN)
+
+def stats():
+    return {
+        **_counters,
+        "breaker_state": breaker.state,
+        "breaker_open": breaker.state != "closed",
+        "breaker_opens": breaker.opens,
+        "consecutive_failures": breaker.failures,
+        "limiter": limiter.stats(),
+    }
+
+def estimate_tokens(messages, max_tokens):
+    chars = sum(len(m.get("content") or "") for m in messages)
+    return int(chars / OPENAI_CHARS_PER_TOKEN) + max_tokens
+
+def _is_retryable(e):
+    if isinstance(e, (openai.APIConnectionError, openai.RateLimitError, asyncio.TimeoutError)):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in (408, 409) or e.status_code >= 500
+    return False
+
+def _retry_after(e):
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+def _backoff_delay(attempt, e):
+    retry_after = _retry_after(e)
+    if retry_after is not None:
+        return max(0.0, min(retry_after, OPENAI_BACKOFF_MAX))
+    # Full jitter: одновременно упавшие запросы не возвращаются одной волной
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+
+async def _call_with_retries(call):
+    deadline = time.monotonic() + OPENAI_DEADLINE
+    attempt = 0
+    while True:
+        # Пока breaker открыт (или пробный запрос уже идёт), отказываем сразу, не дожидаясь
+        # кулдауна: повторять ли заказ позже, решает вызывающий
+        wait = breaker.wait_time()
+        if wait:
+            _counters["rejected"] += 1
+            raise CircuitOpenError(f"OpenAI circuit is open, retry in {wait:.0f}s")
+
+        _counters["calls"] += 1
+        try:
+            result = await asyncio.wait_for(call(), timeout=max(deadline - time.monotonic(), 0.001))
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception as e:
+            retryable = _is_retryable(e)
+            if retryable:
+                breaker.record_failure()
+            else:
+                # 400 и прочие ошибки запроса — OpenAI отвечает, это не деградация
+                breaker.record_success()
+            delay = _backoff_delay(attempt, e) if retryable else None
+            if (
+                delay is None
+                or attempt >= OPENAI_MAX_RETRIES
+                or time.monotonic() + delay > deadline
+            ):
+                _counters["failures"] += 1
+                raise
+            _counters["retries"] += 1
+            attempt += 1
+            print(f"[OPENAI] {type(e).__name__}: {e}; retry {attempt}/{OPENAI_MAX_RETRIES} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+async def ask_gpt_async(
+    messages, model="gpt-4-turbo", max_tokens=2500, temperature=0.9, cache=False, on_text=None,
+    priority=PRIORITY_HIGH, labels=None,
+):
+    # Не блокирует event loop бота: пока ждём ответ, другие апдейты обрабатываются.
+    # on_text(text) — потоковый режим: вызывается с уже полученным текстом после каждого фрагмента.
+    # priority — полоса в планировщике лимитов: PRIORITY_LOW пропускает вперёд первые генерации.
+    # labels — метки для счётчика токенов, например {"product": "destiny", "part": "1"}
+    if cache:
+        key = llm_cache.make_key(model, messages, max_tokens=max_tokens, temperature=temperature)
+        cached = llm_cache.get(key)
+        if cached is not None:
+            if on_text:
+                on_text(cached)
+            return cached
+
+    tokens = estimate_tokens(messages, max_tokens)
+
+    async def call():
+        # Бюджет RPM/TPM тратит каждая попытка, включая повторы.
+        # Слот семафора держим только на время запроса, не на паузы между повторами
+        with tracing.span("openai.rate_limit", tokens=tokens, priority=priority):
+            await limiter.acquire(tokens, priority)
+        async with _semaphore:
+            with tracing.span("openai.request", model=model, stream=bool(on_text)) as span_attrs:
+                # Задержка и исход запроса — для выбора модели в model_router
+                start, ok = time.monotonic(), False
+                try:
+                    if on_text:
+                        text, usage = await _stream_completion(messages, model, max_tokens, temperature, on_text)
+                    else:
+                        resp = await async_client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            max_tokens=max_tokens,
+                            temperature=temperature,
+                        )
+                        text, usage = resp.choices[0].message.content, resp.usage
+                    ok = True
+                    if labels is not None and usage is not None:
+                        metrics.GPT_TOKENS.inc(usage.prompt_tokens, model=model, direction="in", **labels)
+                        metrics.GPT_TOKENS.inc(usage.completion_tokens, model=model, direction="out", **labels)
+                    if usage is not None:
+                        span_attrs.update(tokens_in=usage.prompt_tokens, tokens_out=usage.completion_tokens)
+                    return text
+                finally:
+                    model_router.record(model, time.monotonic() - start, ok)
+
+    text = (await _call_with_retries(call)).strip()
+    if cache:
+        llm_cache.put(key, text)
+    return text
+
+async def _stream_completion(messages, model, max_tokens, temperature, on_text):
+    stream = await async_client.chat.completions.create(
         model=model,
         messages=messages,
         max_tokens=max_tokens,
         temperature=temperature,
+        stream=True,
+        # Последний фрагмент потока приходит без choices, но с расходом токенов
+        stream_options={"include_usage": True},
     )
-    return resp.choices[0].message.content.strip()
+    text, usage = "", None
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            text += delta
+            on_text(text)
+        if chunk.usage is not None:
+            usage = chunk.usage
+    return text, usage
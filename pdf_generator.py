@@ -3,10 +3,16 @@
 import os
 import io
 import re
+import copy
+import time
+import asyncio
+import multiprocessing
 import qrcode
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, HRFlowable, Image
-from reportlab.platypus import Table, TableStyle, Image as RLImage
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, HRFlowable, Image, Flowable
+from reportlab.platypus import Table, TableStyle
 from reportlab.lib.units import mm
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_LEFT
@@ -14,6 +20,8 @@ from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfbase.pdfdoc import PDFImageXObject, PDFObjectReference
+from reportlab.lib.utils import ImageReader, _digester
 
 # Пути к шрифтам и логотипу
 FONT_PATH = os.path.join(os.path.dirname(__file__), "DejaVuSans.ttf")
@@ -24,6 +32,13 @@ AVATAR_MAP = {
     "income": "cat_avatar_career.png",
     "compatibility": "cat_avatar_comp.png",
 }
+LOGO_PATH = os.path.join(os.path.dirname(__file__), "static", "logo.png")
+TITLE_MAP = {
+    "destiny": "Карта предназначения — АстроКотский",
+    "solyar": "Годовой путь — АстроКотский",
+    "income": "Карьерный разбор — АстроКотский",
+    "compatibility": "Совместимость — АстроКотский",
+}
 COLOR_MAP = {
     "destiny": "#FBBF24",        # Желтый
     "solyar": "#60A5FA",         # Голубой
@@ -66,9 +81,17 @@ COMPAT_HEADERS = [
     "Краткий прогноз на ближайшие месяцы",
 ]
 
+# Сколько процессов рендерят PDF параллельно (ReportLab держит GIL — потоки тут не помогут)
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", str(os.cpu_count() or 2)))
+
 pdfmetrics.registerFont(TTFont("DejaVuSans", FONT_PATH))
 pdfmetrics.registerFont(TTFont("DejaVuSans-Bold", FONT_BOLD_PATH))
 
+_render_pool = None
+# Шаблоны рендера по product_type и готовые картинки по пути — живут весь процесс
+_templates = {}
+_images = {}
+
 def get_cat_avatar_path(product_type):
     name = AVATAR_MAP.get(product_type, "cat_avatar_destiny.png")
     return os.path.join(os.path.dirname(__file__), "static", name)
@@ -87,8 +110,61 @@ def get_headers_for_product(product_type):
         return COMPAT_HEADERS
     return []
 
+class CachedImage:
+    # PNG, один раз декодированный и закодированный в PDF XObject.
+    # В каждый новый документ подкладываем копию готового объекта — тогда
+    # canvas.drawImage находит его по имени и не пережимает картинку заново.
+    def __init__(self, path):
+        self.path = path
+        self.reader = ImageReader(path)
+        # То же имя, которое drawImage вычисляет для пути к файлу с mask='auto'
+        self.name = _digester(f"{path}auto".encode("utf-8"))
+        self.xobject = PDFImageXObject(self.name, self.reader, mask="auto")
+
+    def _register(self, canvas):
+        doc = canvas._doc
+        reg_name = doc.getXObjectName(self.name)
+        if doc.idToObject.get(reg_name):
+            return
+        img = copy.copy(self.xobject)
+        smask = img.__dict__.pop("_smask", None)
+        canvas._setXObjects(img)
+        doc.Reference(img, reg_name)
+        doc.addForm(self.name, img)
+        if smask is not None:
+            smask = copy.copy(smask)
+            mask_reg_name = doc.getXObjectName(smask.name)
+            if doc.idToObject.get(mask_reg_name):
+                img.smask = PDFObjectReference(mask_reg_name)
+            else:
+                canvas._setXObjects(smask)
+                img.smask = doc.Reference(smask, mask_reg_name)
+
+    def draw(self, canvas, x, y, width, height):
+        self._register(canvas)
+        canvas.drawImage(self.path, x, y, width=width, height=height, mask="auto")
+
+class CachedImageFlowable(Flowable):
+    def __init__(self, image, width, height):
+        super().__init__()
+        self.image = image
+        self.width = width
+        self.height = height
+        self.hAlign = "CENTER"
+
+    def wrap(self, availWidth, availHeight):
+        return self.width, self.height
+
+    def draw(self):
+        self.image.draw(self.canv, 0, 0, self.width, self.height)
+
+def get_cached_image(path):
+    image = _images.get(path)
+    if image is None:
+        image = _images[path] = CachedImage(path)
+    return image
+
 def draw_watermark(canvas, doc):
-    logo_path = os.path.join(os.path.dirname(__file__), "static", "logo.png")
     page_width, page_height = A4
     logo_width = page_width 
     logo_height = page_height
@@ -99,17 +175,10 @@ def draw_watermark(canvas, doc):
         canvas.setFillAlpha(0.07)  # 10% opacity
     except AttributeError:
         pass
-    canvas.drawImage(logo_path, x, y, width=logo_width, height=logo_height, mask='auto')
+    get_cached_image(LOGO_PATH).draw(canvas, x, y, logo_width, logo_height)
     canvas.restoreState()
 
-def text_to_pdf(text: str, product_type="destiny") -> bytes:
-    buf = io.BytesIO()
-    doc = SimpleDocTemplate(
-        buf, pagesize=A4, leftMargin=40, rightMargin=40, topMargin=50, bottomMargin=50
-    )
-
-    cat_avatar_path = get_cat_avatar_path(product_type)
-    brand_color = get_brand_color(product_type)
+def build_styles(brand_color):
     styles = getSampleStyleSheet()
     styles.add(ParagraphStyle(
         name='Body',
@@ -138,49 +207,73 @@ def text_to_pdf(text: str, product_type="destiny") -> bytes:
         alignment=TA_LEFT,
         spaceAfter=20,
     ))
+    return styles
+
+def build_render_template(product_type):
+    brand_color = colors.HexColor(get_brand_color(product_type))
+    styles = build_styles(get_brand_color(product_type))
+    title = TITLE_MAP.get(product_type, TITLE_MAP["destiny"])
+    avatar = get_cached_image(get_cat_avatar_path(product_type))
+    return {
+        "styles": styles,
+        "brand_color": brand_color,
+        "headers": [h.lower() for h in get_headers_for_product(product_type)],
+        "title_row": [Paragraph(title, styles["BigTitle"]), CachedImageFlowable(avatar, 165, 165)],
+        "title_style": TableStyle([
+            ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+            ('ALIGN', (1,0), (1,0), 'RIGHT'),
+            ('LEFTPADDING', (0,0), (-1,-1), 0),
+            ('RIGHTPADDING', (0,0), (-1,-1), 0),
+            ('TOPPADDING', (0,0), (-1,-1), 0),
+            ('BOTTOMPADDING', (0,0), (-1,-1), 0),
+        ]),
+    }
+
+def get_render_template(product_type):
+    # Стили, цвета, заголовок и картинки строятся один раз на product_type
+    template = _templates.get(product_type)
+    if template is None:
+        template = _templates[product_type] = build_render_template(product_type)
+    return template
+
+def text_to_pdf(text: str, product_type="destiny") -> bytes:
+    buf = io.BytesIO()
+    # invariant — без даты создания и случайного ID: одинаковый текст даёт байт-в-байт
+    # одинаковый PDF, и storage не загружает его повторно
+    doc = SimpleDocTemplate(
+        buf, pagesize=A4, leftMargin=40, rightMargin=40, topMargin=50, bottomMargin=50,
+        invariant=True,
+    )
+
+    template = get_render_template(product_type)
+    styles = template["styles"]
+    brand_color = template["brand_color"]
 
     story = []
 
-    # Заголовок и котик сверху
-    if product_type == "solyar":
-        big_title = Paragraph("Годовой путь — АстроКотский", styles["BigTitle"])
-    elif product_type == "income":
-        big_title = Paragraph("Карьерный разбор — АстроКотский", styles["BigTitle"])
-    elif product_type == "compatibility":
-        big_title = Paragraph("Совместимость — АстроКотский", styles["BigTitle"])
-    else:
-        big_title = Paragraph("Карта предназначения — АстроКотский", styles["BigTitle"])
-
-    cat_avatar = RLImage(cat_avatar_path, width=165, height=165)
+    # Заголовок и котик сверху — собираем из готового прототипа шаблона
     title_table = Table(
-        [[big_title, cat_avatar]],
+        [template["title_row"]],
         colWidths=[440, 90],
         hAlign='LEFT'
     )
-    title_table.setStyle(TableStyle([
-        ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-        ('ALIGN', (1,0), (1,0), 'RIGHT'),
-        ('LEFTPADDING', (0,0), (-1,-1), 0),
-        ('RIGHTPADDING', (0,0), (-1,-1), 0),
-        ('TOPPADDING', (0,0), (-1,-1), 0),
-        ('BOTTOMPADDING', (0,0), (-1,-1), 0),
-    ]))
+    title_table.setStyle(template["title_style"])
     story.append(title_table)
     story.append(Spacer(1, 24))
 
-    headers = [h.lower() for h in get_headers_for_product(product_type)]
+    headers = template["headers"]
 
     for block in text.strip().split('\n\n'):
         block = block.strip()
         block_clean = block.lower().rstrip(":,.!? ")
         if any(block_clean.startswith(h) for h in headers):
             story.append(Paragraph(block, styles["Header"]))
-            story.append(HRFlowable(width="100%", thickness=1, color=colors.HexColor(brand_color), spaceBefore=4, spaceAfter=10))
+            story.append(HRFlowable(width="100%", thickness=1, color=brand_color, spaceBefore=4, spaceAfter=10))
         # Markdown-заголовок
         elif re.match(r"^#+\s*", block):
             clean = re.sub(r"^#+\s*", "", block)
             story.append(Paragraph(clean, styles["Header"]))
-            story.append(HRFlowable(width="100%", thickness=1, color=colors.HexColor(brand_color), spaceBefore=4, spaceAfter=10))
+            story.append(HRFlowable(width="100%", thickness=1, color=brand_color, spaceBefore=4, spaceAfter=10))
         # Короткая строка — тоже заголовок (мягче условие!)
         elif (
             len(block) < 80
@@ -189,7 +282,7 @@ def text_to_pdf(text: str, product_type="destiny") -> bytes:
             and block != ""
         ):
             story.append(Paragraph(block, styles["Header"]))
-            story.append(HRFlowable(width="100%", thickness=1, color=colors.HexColor(brand_color), spaceBefore=4, spaceAfter=10))
+            story.append(HRFlowable(width="100%", thickness=1, color=brand_color, spaceBefore=4, spaceAfter=10))
         else:
             for line in block.split('\n'):
                 line = line.strip()
@@ -207,10 +300,61 @@ def text_to_pdf(text: str, product_type="destiny") -> bytes:
     )
     return buf.getvalue()
 
-def upload_pdf_to_storage(user_id: str, pdf_bytes: bytes) -> str:
-    from supabase_client import supabase  # импортировать client из клиента Supabase
-    import time
-    bucket = supabase.storage.from_("destiny-reports")
-    fname = f"{user_id}_{int(time.time())}.pdf"
-    bucket.upload(fname, pdf_bytes)
-    return bucket.get_public_url(fname)
+def _init_render_worker():
+    # Прогрев процесса: шрифты уже зарегистрированы при импорте модуля,
+    # шаблоны всех продуктов строятся заранее, пробный рендер подтягивает метрики глифов
+    for product_type in COLOR_MAP:
+        get_render_template(product_type)
+        text_to_pdf("Прогрев", product_type=product_type)
+
+def _render_worker_ready(hold):
+    # Задержка нужна, чтобы каждый процесс пула получил свой пинг и успел прогреться
+    time.sleep(hold)
+    return os.getpid()
+
+def get_render_pool():
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = ProcessPoolExecutor(
+            max_workers=PDF_RENDER_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_render_worker,
+        )
+    return _render_pool
+
+async def warm_render_pool():
+    # Поднимаем все процессы заранее, чтобы первый заказ не ждал старта и прогрева
+    loop = asyncio.get_running_loop()
+    pool = get_render_pool()
+    pids = await asyncio.gather(
+        *(loop.run_in_executor(pool, _render_worker_ready, 0.5) for _ in range(PDF_RENDER_WORKERS))
+    )
+    print(f"[PDF] render pool ready: {len(set(pids))} process(es)")
+
+def shutdown_render_pool():
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=False, cancel_futures=True)
+        _render_pool = None
+
+async def _restart_render_pool(broken):
+    # Пул, в котором умер процесс, уже не починить — поднимаем новый.
+    # Пересоздаёт только первый, кто заметил поломку, остальные берут новый пул
+    global _render_pool
+    if _render_pool is not broken:
+        return
+    print("[PDF] render pool broken, restarting")
+    broken.shutdown(wait=False, cancel_futures=True)
+    _render_pool = None
+    await warm_render_pool()
+
+async def render_pdf(text: str, product_type="destiny") -> bytes:
+    # Не блокирует event loop: вёрстка идёт в отдельном процессе
+    loop = asyncio.get_running_loop()
+    pool = get_render_pool()
+    try:
+        return await loop.run_in_executor(pool, text_to_pdf, text, product_type)
+    except BrokenProcessPool:
+        # Процесс рендера убили (OOM, segfault) — один повтор на свежем пуле
+        await _restart_render_pool(pool)
+        return await loop.run_in_executor(get_render_pool(), text_to_pdf, text, product_type)
@@ -0,0 +1,102 @@
+# rate_limiter.py
+
+import time
+import heapq
+import asyncio
+import itertools
+from collections import deque
+from metrics import percentile
+
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+
+class TokenBucketScheduler:
+    # Два ведра — запросы в минуту и токены в минуту, пополняются непрерывно.
+    # Ожидающие стоят в одной очереди по (priority, порядок прихода): пока первый
+    # в очереди ждёт бюджет, следующие его не обгоняют — иначе крупные запросы
+    # голодали бы за мелкими. rpm/tpm = 0 — ограничение выключено.
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._timer = None
+        self._wait_times = deque(maxlen=500)
+        self.granted = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _delay_for(self, tokens):
+        delays = [0.0]
+        if self.rpm and self._requests < 1:
+            delays.append((1 - self._requests) * 60 / self.rpm)
+        if self.tpm and self._tokens < tokens:
+            delays.append((tokens - self._tokens) * 60 / self.tpm)
+        return max(delays)
+
+    def _dispatch(self):
+        self._timer = None
+        self._refill()
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                # Ожидание отменили
+                heapq.heappop(self._waiters)
+                continue
+            # Запрос больше всего ведра иначе не прошёл бы никогда
+            tokens = min(tokens, self.tpm) if self.tpm else 0
+            delay = self._delay_for(tokens)
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            if self.rpm:
+                self._requests -= 1
+            self._tokens -= tokens
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+
+    async def acquire(self, tokens, priority=PRIORITY_HIGH):
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), tokens, future))
+        if self._waiters[0][3] is future and self._timer is not None:
+            # Новый запрос обогнал ждущую голову (например, HIGH перед LOW) —
+            # таймер считался под чужой размер, проверяем бюджет заново
+            self._timer.cancel()
+            self._timer = None
+        if self._timer is None:
+            self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Освободилось место в голове очереди — пусть следующий не ждёт таймера
+            if self._timer is not None:
+                self._timer.cancel()
+            self._dispatch()
+            raise
+        waited = time.monotonic() - start
+        self._wait_times.append(waited)
+        self.granted += 1
+        return waited
+
+    def stats(self):
+        waiting = [priority for priority, _, _, future in self._waiters if not future.done()]
+        return {
+            "waiting": len(waiting),
+            "waiting_low": waiting.count(PRIORITY_LOW),
+            "granted": self.granted,
+            "wait_p50": percentile(self._wait_times, 0.5),
+            "wait_p95": percentile(self._wait_times, 0.95),
+            "requests_available": self._requests if self.rpm else None,
+            "tokens_available": self._tokens if self.tpm else None,
+        }
@@ -0,0 +1,269 @@
+# report_queue.py
+
+import os
+import json
+import time
+import hashlib
+import asyncio
+from collections import deque
+from contextlib import closing
+import sqlite_db
+import tracing
+from metrics import percentile
+
+# Очередь отчётов лежит в локальном SQLite — переживает рестарт процесса
+REPORT_QUEUE_PATH = os.getenv(
+    "REPORT_QUEUE_PATH",
+    os.path.join(os.path.dirname(__file__), "data", "report_jobs.sqlite3"),
+)
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "4"))
+# Как часто воркер сам заглядывает в очередь (задачи могут прийти из другого процесса)
+REPORT_QUEUE_POLL = float(os.getenv("REPORT_QUEUE_POLL", "2"))
+
+_wakeup = asyncio.Event()
+_workers = []
+# Последние времена ожидания в очереди и выполнения (сек) — для stats()
+_wait_times = deque(maxlen=200)
+_run_times = deque(maxlen=200)
+
+def _connect():
+    return sqlite_db.connect(REPORT_QUEUE_PATH, _init_schema)
+
+def _init_schema(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tg_id INTEGER NOT NULL,
+            product_type TEXT NOT NULL,
+            inputs TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            flight_key TEXT,
+            targets TEXT NOT NULL DEFAULT '[]',
+            trace_id TEXT
+        )
+        """
+    )
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+    if "flight_key" not in columns:
+        conn.execute("ALTER TABLE jobs ADD COLUMN flight_key TEXT")
+        conn.execute("ALTER TABLE jobs ADD COLUMN targets TEXT NOT NULL DEFAULT '[]'")
+    if "trace_id" not in columns:
+        conn.execute("ALTER TABLE jobs ADD COLUMN trace_id TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_flight_key ON jobs (flight_key, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs (tg_id, product_type, id)")
+
+def _row_to_job(row):
+    job = dict(row)
+    job["inputs"] = json.loads(job["inputs"])
+    job["targets"] = json.loads(job["targets"])
+    return job
+
+def flight_key(tg_id, product_type, inputs):
+    # Одинаковые входные данные — один и тот же отчёт
+    raw = json.dumps([tg_id, product_type, inputs], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def enqueue(tg_id, product_type, inputs=None, target=None):
+    # inputs — всё, от чего зависит текст отчёта; target — куда его доставить
+    # ({"chat_id": ..., "loading_message_id": ...}), None — только сохранить PDF.
+    # Если такой же отчёт уже в очереди или генерируется, новую задачу не создаём:
+    # target добавляется к ней, и PDF получат все, кто его ждёт.
+    # Задача продолжает текущую трассу (webhook оплаты) или начинает свою
+    inputs = inputs or {}
+    trace_id = tracing.current_trace_id() or tracing.new_trace_id()
+    key = flight_key(tg_id, product_type, inputs)
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT id, targets, trace_id FROM jobs WHERE flight_key = ? AND status IN ('queued', 'running') "
+            "ORDER BY id LIMIT 1",
+            (key,),
+        ).fetchone()
+        if row is not None:
+            job_id = row["id"]
+            if target is not None:
+                targets = json.loads(row["targets"]) + [target]
+                conn.execute(
+                    "UPDATE jobs SET targets = ? WHERE id = ?",
+                    (json.dumps(targets, ensure_ascii=False), job_id),
+                )
+        else:
+            cur = conn.execute(
+                "INSERT INTO jobs (tg_id, product_type, inputs, created_at, flight_key, targets, trace_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    tg_id, product_type, json.dumps(inputs, ensure_ascii=False), time.time(),
+                    key, json.dumps([target] if target is not None else [], ensure_ascii=False),
+                    trace_id,
+                ),
+            )
+            job_id = cur.lastrowid
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+    if row is not None:
+        # Пользователь ждёт отчёт, который уже генерируется (например, после оплаты) — отмечаем в его трассе
+        now = time.time()
+        tracing.record_span(
+            "queue.attach", now, now, trace_id=row["trace_id"],
+            job_id=job_id, tg_id=tg_id, product=product_type,
+        )
+        print(f"[QUEUE] attached to in-flight job {job_id}: tg_id={tg_id} product={product_type}")
+    else:
+        _wakeup.set()
+        print(f"[QUEUE] enqueued job {job_id}: tg_id={tg_id} product={product_type}")
+    return job_id
+
+def last_trace_id(tg_id, product_type):
+    # Трасса последнего заказа продукта: готовый отчёт пользователь забирает позже,
+    # уже вне задачи, и эта доставка тоже должна попасть в трассу заказа
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT trace_id FROM jobs WHERE tg_id = ? AND product_type = ? ORDER BY id DESC LIMIT 1",
+            (tg_id, product_type),
+        ).fetchone()
+    return row["trace_id"] if row is not None else None
+
+def targets(job_id):
+    # Текущие получатели без закрытия задачи — для промежуточных уведомлений о прогрессе
+    with closing(_connect()) as conn:
+        row = conn.execute("SELECT targets FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return json.loads(row["targets"]) if row is not None else []
+
+def seal(job_id):
+    # Закрывает задачу для новых подписчиков и отдаёт список получателей.
+    # Кто придёт позже, создаст новую задачу — она найдёт готовый PDF в базе.
+    # Получатели из задачи убираются: если процесс упадёт во время отправки,
+    # recover() не разошлёт отчёт второй раз тем, кто его уже получил.
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT targets FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        conn.execute("UPDATE jobs SET status = 'delivering', targets = '[]' WHERE id = ?", (job_id,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return json.loads(row["targets"]) if row is not None else []
+
+def _claim():
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        started_at = time.time()
+        conn.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ? WHERE id = ?",
+            (started_at, row["id"]),
+        )
+        conn.execute("COMMIT")
+        job = _row_to_job(row)
+        job["started_at"] = started_at
+        job["attempts"] += 1
+        return job
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def _finish(job_id, status, error=None):
+    with closing(_connect()) as conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+            (status, error, time.time(), job_id),
+        )
+
+def recover():
+    # Задачи, которые выполнялись в момент падения процесса, возвращаем в очередь.
+    # У 'delivering' получателей уже нет — повтор только догрузит PDF в storage
+    with closing(_connect()) as conn:
+        cur = conn.execute(
+            "UPDATE jobs SET status = 'queued' WHERE status IN ('running', 'delivering')"
+        )
+        if cur.rowcount:
+            print(f"[QUEUE] requeued {cur.rowcount} interrupted job(s)")
+
+def stats():
+    with closing(_connect()) as conn:
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+    return {
+        "depth": counts.get("queued", 0),
+        "running": counts.get("running", 0) + counts.get("delivering", 0),
+        "done": counts.get("done", 0),
+        "failed": counts.get("failed", 0),
+        "wait_p50": percentile(_wait_times, 0.5),
+        "wait_p95": percentile(_wait_times, 0.95),
+        "run_p50": percentile(_run_times, 0.5),
+        "run_p95": percentile(_run_times, 0.95),
+    }
+
+async def _worker(n, application, runner):
+    while True:
+        job = _claim()
+        if job is None:
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=REPORT_QUEUE_POLL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        wait = job["started_at"] - job["created_at"]
+        _wait_times.append(wait)
+        try:
+            with tracing.trace(job["trace_id"]):
+                tracing.record_span(
+                    "queue.wait", job["created_at"], job["started_at"],
+                    job_id=job["id"], tg_id=job["tg_id"], product=job["product_type"],
+                )
+                with tracing.span(
+                    "report.job", job_id=job["id"], tg_id=job["tg_id"],
+                    product=job["product_type"], attempt=job["attempts"],
+                ):
+                    await runner(application, job)
+        except asyncio.CancelledError:
+            # Остановка процесса — задача останется running и вернётся в очередь через recover()
+            raise
+        except Exception as e:
+            print(f"[QUEUE] job {job['id']} failed:", e)
+            _finish(job["id"], "failed", error=str(e))
+        else:
+            _finish(job["id"], "done")
+        run = time.time() - job["started_at"]
+        _run_times.append(run)
+        print(
+            f"[QUEUE] worker {n} finished job {job['id']} ({job['product_type']}): "
+            f"wait {wait:.1f}s, run {run:.1f}s, depth {stats()['depth']}"
+        )
+
+async def start_workers(application, runner, count=REPORT_WORKERS):
+    recover()
+    for n in range(count):
+        _workers.append(asyncio.create_task(_worker(n, application, runner)))
+    print(f"[QUEUE] started {count} report worker(s), depth {stats()['depth']}")
+
+async def stop_workers():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
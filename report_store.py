@@ -0,0 +1,134 @@
+# report_store.py
+# Готовый текст отчёта сохраняется сразу после GPT — сжатым, в локальном SQLite.
+# Если PDF или загрузка упали, следующая попытка начинает с рендера, а не с GPT.
+# Если упала одна из частей GPT, готовые части тоже сохраняются — повтор запросит только упавшую.
+# Ключ — (tg_id, продукт, хэш промптов): поменял пользователь данные рождения
+# или партнёра — старый текст не подойдёт.
+
+import os
+import json
+import time
+import zlib
+import hashlib
+from contextlib import closing
+import sqlite_db
+
+REPORT_STORE_PATH = os.getenv(
+    "REPORT_STORE_PATH",
+    os.path.join(os.path.dirname(__file__), "data", "reports.sqlite3"),
+)
+# Текст нужен, пока может понадобиться перерендер (потерялся PDF, упала загрузка);
+# старше стольких дней — удаляем, раз в час при очередном save()
+REPORT_STORE_RETENTION_DAYS = float(os.getenv("REPORT_STORE_RETENTION_DAYS", "30"))
+
+_last_purge = 0.0
+
+def _connect():
+    return sqlite_db.connect(REPORT_STORE_PATH, _init_schema)
+
+def _init_schema(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS reports (
+            tg_id INTEGER NOT NULL,
+            product_type TEXT NOT NULL,
+            prompt_hash TEXT NOT NULL,
+            text BLOB NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (tg_id, product_type, prompt_hash)
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS report_parts (
+            tg_id INTEGER NOT NULL,
+            product_type TEXT NOT NULL,
+            prompt_hash TEXT NOT NULL,
+            part INTEGER NOT NULL,
+            text BLOB NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (tg_id, product_type, prompt_hash, part)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS reports_created_at ON reports (created_at)")
+
+def prompt_hash(messages_parts):
+    raw = json.dumps(messages_parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def purge():
+    global _last_purge
+    _last_purge = time.time()
+    cutoff = _last_purge - REPORT_STORE_RETENTION_DAYS * 86400
+    with closing(_connect()) as conn:
+        cur = conn.execute("DELETE FROM reports WHERE created_at < ?", (cutoff,))
+        conn.execute("DELETE FROM report_parts WHERE created_at < ?", (cutoff,))
+    if cur.rowcount:
+        print(f"[REPORTS] purged {cur.rowcount} report text(s) older than {REPORT_STORE_RETENTION_DAYS:g} days")
+
+def save(tg_id, product_type, messages_parts, text):
+    if time.time() - _last_purge > 3600:
+        purge()
+    with closing(_connect()) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO reports (tg_id, product_type, prompt_hash, text, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                tg_id, product_type, prompt_hash(messages_parts),
+                zlib.compress(text.encode("utf-8"), 6), time.time(),
+            ),
+        )
+
+def save_parts(tg_id, product_type, messages_parts, parts):
+    # parts — как в ReportGenerationError.parts: None на месте упавших
+    key = (tg_id, product_type, prompt_hash(messages_parts))
+    now = time.time()
+    with closing(_connect()) as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO report_parts (tg_id, product_type, prompt_hash, part, text, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (*key, i, zlib.compress(part.encode("utf-8"), 6), now)
+                for i, part in enumerate(parts) if part is not None
+            ],
+        )
+
+def load_parts(tg_id, product_type, messages_parts):
+    # Готовые части прошлой попытки для generate_report_text(parts=...), None — сохранённых нет
+    with closing(_connect()) as conn:
+        rows = conn.execute(
+            "SELECT part, text FROM report_parts WHERE tg_id = ? AND product_type = ? AND prompt_hash = ?",
+            (tg_id, product_type, prompt_hash(messages_parts)),
+        ).fetchall()
+    if not rows:
+        return None
+    parts = [None] * len(messages_parts)
+    for part, text in rows:
+        if part < len(parts):
+            parts[part] = zlib.decompress(text).decode("utf-8")
+    return parts
+
+def clear_parts(tg_id, product_type):
+    with closing(_connect()) as conn:
+        conn.execute(
+            "DELETE FROM report_parts WHERE tg_id = ? AND product_type = ?", (tg_id, product_type)
+        )
+
+def load(tg_id, product_type, messages_parts):
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT text FROM reports WHERE tg_id = ? AND product_type = ? AND prompt_hash = ?",
+            (tg_id, product_type, prompt_hash(messages_parts)),
+        ).fetchone()
+    return zlib.decompress(row[0]).decode("utf-8") if row else None
+
+def exists(tg_id, product_type):
+    # Был ли у пользователя хоть один текст этого продукта — тогда новая генерация повторная
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT 1 FROM reports WHERE tg_id = ? AND product_type = ? LIMIT 1",
+            (tg_id, product_type),
+        ).fetchone()
+    return row is not None
@@ -0,0 +1,85 @@
+# server.py
+# Один ASGI-процесс для Telegram webhook и Stripe webhook.
+# Запуск: BOT_MODE=webhook python bot.py  (или uvicorn server:app)
+
+import os
+import logging
+from contextlib import asynccontextmanager
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+
+import bot
+import webhook
+import metrics
+
+# Публичный адрес сервиса, например https://astrobot.example.com
+WEBHOOK_BASE_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram")
+# Telegram присылает его в X-Telegram-Bot-Api-Secret-Token — чужие запросы отбрасываем
+WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", "40"))
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8080"))
+
+logger = logging.getLogger(__name__)
+
+application = bot.build_application(updater=False)
+
+async def telegram_webhook(request: Request):
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return Response(status_code=403)
+    update = Update.de_json(await request.json(), application.bot)
+    await application.update_queue.put(update)
+    return Response()
+
+async def healthz(request: Request):
+    return PlainTextResponse("ok")
+
+def register_metrics():
+    # Метрики бота и Stripe webhook в одном /metrics
+    bot.register_metrics()
+    webhook.register_metrics()
+
+register_metrics()
+
+@asynccontextmanager
+async def lifespan(app):
+    # run_polling/run_webhook тут не используются, поэтому post_init/post_shutdown зовём сами
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.bot.set_webhook(
+        url=f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    await application.start()
+    await webhook.start()
+    logger.info("Bot started (webhook %s%s)", WEBHOOK_BASE_URL, WEBHOOK_PATH)
+    try:
+        yield
+    finally:
+        await webhook.stop()
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+app = Starlette(
+    routes=[
+        Route(WEBHOOK_PATH, telegram_webhook, methods=["POST"]),
+        Route("/healthz", healthz),
+        Route("/metrics", metrics.endpoint),
+        *webhook.routes,
+    ],
+    lifespan=lifespan,
+)
+
+def run():
+    uvicorn.run(app, host=HOST, port=PORT)
@@ -0,0 +1,22 @@
+# sqlite_db.py
+# Локальные SQLite-базы бота: очередь отчётов, inbox Stripe, тексты отчётов.
+# Все в WAL и autocommit (транзакции — явным BEGIN IMMEDIATE), строки — sqlite3.Row.
+# Схема создаётся при первом подключении процесса к файлу.
+
+import os
+import sqlite3
+
+_ready = set()
+
+def connect(path, init_schema, synchronous=None):
+    # init_schema(conn) — CREATE TABLE IF NOT EXISTS и миграции колонок
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    if synchronous:
+        conn.execute(f"PRAGMA synchronous={synchronous}")
+    if path not in _ready:
+        init_schema(conn)
+        _ready.add(path)
+    return conn
@@ -0,0 +1,56 @@
+# storage.py
+# Асинхронная загрузка PDF в Supabase Storage через REST API и общий httpx.AsyncClient.
+# Объект называется sha256 содержимого: одинаковый PDF второй раз не загружается —
+# хватает HEAD-запроса, а одновременные загрузки не затирают друг друга.
+
+import os
+import hashlib
+from supabase_http import SupabaseClient, SUPABASE_URL
+
+STORAGE_BUCKET = os.getenv("STORAGE_BUCKET", "destiny-reports")
+STORAGE_TIMEOUT = float(os.getenv("STORAGE_TIMEOUT", "60"))
+STORAGE_MAX_CONNECTIONS = int(os.getenv("STORAGE_MAX_CONNECTIONS", "10"))
+
+_supabase = SupabaseClient("/storage/v1", STORAGE_TIMEOUT, STORAGE_MAX_CONNECTIONS)
+_get_client = _supabase.get
+close = _supabase.close
+_counters = {"uploads": 0, "dedup_hits": 0, "bytes_uploaded": 0}
+
+def object_name(pdf_bytes):
+    return f"{hashlib.sha256(pdf_bytes).hexdigest()}.pdf"
+
+def public_url(name):
+    return f"{SUPABASE_URL}/storage/v1/object/public/{STORAGE_BUCKET}/{name}"
+
+async def exists(name):
+    resp = await _get_client().head(f"/object/{STORAGE_BUCKET}/{name}")
+    if resp.status_code == 200:
+        return True
+    # Storage отвечает на отсутствующий объект 400 или 404 в зависимости от версии
+    if resp.status_code in (400, 404):
+        return False
+    resp.raise_for_status()
+    return False
+
+async def upload_pdf(pdf_bytes):
+    name = object_name(pdf_bytes)
+    if await exists(name):
+        _counters["dedup_hits"] += 1
+        return public_url(name)
+
+    resp = await _get_client().post(
+        f"/object/{STORAGE_BUCKET}/{name}",
+        content=pdf_bytes,
+        headers={"Content-Type": "application/pdf", "x-upsert": "false"},
+    )
+    # Тот же PDF успели загрузить параллельно — объект уже есть, это не ошибка
+    if resp.status_code == 409 or (resp.status_code == 400 and "Duplicate" in resp.text):
+        _counters["dedup_hits"] += 1
+        return public_url(name)
+    resp.raise_for_status()
+    _counters["uploads"] += 1
+    _counters["bytes_uploaded"] += len(pdf_bytes)
+    return public_url(name)
+
+def stats():
+    return dict(_counters)
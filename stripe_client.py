@@ -1,4 +1,7 @@
 import os
+import time
+import asyncio
+from collections import OrderedDict
 import stripe
 
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
@@ -9,26 +12,93 @@ PRICE_IDS = {
     "compatibility": os.getenv("STRIPE_PRICE_ID_COMPAT"),
     # Добавишь другие продукты по аналогии
 }
+STRIPE_TIMEOUT = float(os.getenv("STRIPE_TIMEOUT", "20"))
+# Сколько живёт checkout-сессия (Stripe допускает от 30 минут до 24 часов)
+CHECKOUT_SESSION_TTL = int(os.getenv("CHECKOUT_SESSION_TTL", str(23 * 3600)))
+# Не отдаём ссылку, которая истечёт раньше, чем пользователь успеет оплатить
+CHECKOUT_SESSION_MARGIN = int(os.getenv("CHECKOUT_SESSION_MARGIN", "900"))
+CHECKOUT_CACHE_SIZE = int(os.getenv("CHECKOUT_CACHE_SIZE", "10000"))
 
 stripe.api_key = STRIPE_SECRET_KEY
 
-def create_checkout_session(tg_id: int, product_type: str, success_url: str, cancel_url: str) -> str:
+# Асинхронный клиент с общим пулом соединений httpx; создаётся при первой оплате
+_http_client = None
+_stripe = None
+
+# (tg_id, product_type, success_url, cancel_url) -> (url, expires_at)
+_sessions = OrderedDict()
+_pending = {}
+_counters = {"hits": 0, "misses": 0}
+
+def _get_client():
+    global _http_client, _stripe
+    if _stripe is None:
+        _http_client = stripe.HTTPXClient(timeout=STRIPE_TIMEOUT)
+        _stripe = stripe.StripeClient(STRIPE_SECRET_KEY, http_client=_http_client)
+    return _stripe
+
+async def _create_checkout_session(tg_id, product_type, success_url, cancel_url):
     price_id = PRICE_IDS.get(product_type)
     if not price_id:
         raise Exception(f"No price_id for product_type: {product_type}")
 
-    session = stripe.checkout.Session.create(
-        payment_method_types=["card"],
-        line_items=[{
+    session = await _get_client().v1.checkout.sessions.create_async(params={
+        "payment_method_types": ["card"],
+        "line_items": [{
             "price": price_id,
             "quantity": 1,
         }],
-        mode="payment",
-        success_url=f"{success_url}?session_id={{CHECKOUT_SESSION_ID}}&tg_id={tg_id}",
-        cancel_url=cancel_url,
-        metadata={
-            "tg_id": tg_id,
+        "mode": "payment",
+        "success_url": f"{success_url}?session_id={{CHECKOUT_SESSION_ID}}&tg_id={tg_id}",
+        "cancel_url": cancel_url,
+        "expires_at": int(time.time()) + CHECKOUT_SESSION_TTL,
+        "metadata": {
+            "tg_id": str(tg_id),
             "product_type": product_type
         },
-    )
-    return session.url
+    })
+    return session.url, session.expires_at
+
+async def get_checkout_url(tg_id: int, product_type: str, success_url: str, cancel_url: str) -> str:
+    # Открытая сессия того же пользователя и продукта переиспользуется до истечения —
+    # повторный заход на экран оплаты не ходит в Stripe
+    key = (tg_id, product_type, success_url, cancel_url)
+    cached = _sessions.get(key)
+    if cached is not None and cached[1] - CHECKOUT_SESSION_MARGIN > time.time():
+        _sessions.move_to_end(key)
+        _counters["hits"] += 1
+        return cached[0]
+
+    # Два быстрых нажатия подряд ждут одну и ту же сессию
+    pending = _pending.get(key)
+    if pending is not None:
+        url, _ = await asyncio.shield(pending)
+        return url
+
+    _counters["misses"] += 1
+    task = asyncio.ensure_future(_create_checkout_session(tg_id, product_type, success_url, cancel_url))
+    _pending[key] = task
+    try:
+        url, expires_at = await asyncio.shield(task)
+    finally:
+        _pending.pop(key, None)
+    _sessions[key] = (url, expires_at)
+    _sessions.move_to_end(key)
+    while len(_sessions) > CHECKOUT_CACHE_SIZE:
+        _sessions.popitem(last=False)
+    return url
+
+def forget_checkout(tg_id, product_type):
+    # Сессия оплачена — следующая покупка получит новую
+    for key in [k for k in _sessions if k[:2] == (tg_id, product_type)]:
+        del _sessions[key]
+
+def stats():
+    return {**_counters, "size": len(_sessions)}
+
+async def close():
+    global _http_client, _stripe
+    if _http_client is not None:
+        await _http_client.close_async()
+    _http_client = None
+    _stripe = None
@@ -0,0 +1,200 @@
+# stripe_inbox.py
+# Входящие события Stripe: endpoint только проверяет подпись и кладёт событие сюда,
+# Supabase и генерацию отчётов обрабатывает фоновый consumer пачками.
+
+import os
+import time
+import asyncio
+import logging
+from contextlib import closing
+import sqlite_db
+
+STRIPE_INBOX_PATH = os.getenv(
+    "STRIPE_INBOX_PATH",
+    os.path.join(os.path.dirname(__file__), "data", "stripe_inbox.sqlite3"),
+)
+STRIPE_BATCH_SIZE = int(os.getenv("STRIPE_BATCH_SIZE", "50"))
+STRIPE_INBOX_POLL = float(os.getenv("STRIPE_INBOX_POLL", "2"))
+# Stripe уже получил 200 и событие не передоставит — оплаченный заказ повторяем, пока
+# Supabase не оживёт: 30с, 1м, 2м, ... до часа между попытками, всего около суток.
+# После стольких неудачных попыток событие остаётся в статусе failed
+STRIPE_MAX_ATTEMPTS = int(os.getenv("STRIPE_MAX_ATTEMPTS", "30"))
+STRIPE_RETRY_DELAY = float(os.getenv("STRIPE_RETRY_DELAY", "30"))
+STRIPE_RETRY_MAX_DELAY = float(os.getenv("STRIPE_RETRY_MAX_DELAY", "3600"))
+# Сколько помним обработанные события. Stripe повторяет доставку до 3 дней
+STRIPE_INBOX_RETENTION_DAYS = float(os.getenv("STRIPE_INBOX_RETENTION_DAYS", "30"))
+
+logger = logging.getLogger(__name__)
+
+_wakeup = asyncio.Event()
+_consumer = None
+_last_purge = 0.0
+_counters = {"received": 0, "duplicates": 0}
+
+def _connect():
+    # Событие должно пережить падение процесса сразу после ответа 200
+    return sqlite_db.connect(STRIPE_INBOX_PATH, _init_schema, synchronous="NORMAL")
+
+def _init_schema(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS events (
+            id TEXT PRIMARY KEY,
+            type TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            received_at REAL NOT NULL,
+            available_at REAL NOT NULL,
+            processed_at REAL,
+            dedupe_key TEXT
+        )
+        """
+    )
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(events)")}
+    if "dedupe_key" not in columns:
+        conn.execute("ALTER TABLE events ADD COLUMN dedupe_key TEXT")
+    # Второй ключ идемпотентности: одна checkout-сессия — одно событие, даже с разными event.id
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS events_dedupe_key ON events (dedupe_key) "
+        "WHERE dedupe_key IS NOT NULL"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS events_status ON events (status, available_at)")
+
+def add(event_id, event_type, payload, dedupe_key=None):
+    # False — такое событие (или событие с тем же dedupe_key) уже было, обрабатывать не нужно
+    now = time.time()
+    with closing(_connect()) as conn:
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO events (id, type, payload, received_at, available_at, dedupe_key) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (event_id, event_type, payload, now, now, dedupe_key),
+        )
+    _counters["received"] += 1
+    if not cur.rowcount:
+        _counters["duplicates"] += 1
+        print(f"[INBOX] duplicate event {event_id} ({dedupe_key or event_type}) skipped")
+        return False
+    _wakeup.set()
+    return True
+
+def _claim_batch(limit):
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "SELECT * FROM events WHERE status = 'pending' AND available_at <= ? "
+            "ORDER BY received_at LIMIT ?",
+            (time.time(), limit),
+        ).fetchall()
+        conn.executemany(
+            "UPDATE events SET status = 'processing', attempts = attempts + 1 WHERE id = ?",
+            [(row["id"],) for row in rows],
+        )
+        conn.execute("COMMIT")
+        return [dict(row) for row in rows]
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def retry_delay(attempts):
+    return min(STRIPE_RETRY_MAX_DELAY, STRIPE_RETRY_DELAY * 2 ** (attempts - 1))
+
+def _finish(event, error=None):
+    # В event — строка до claim, attempts там ещё без текущей попытки. Возвращает новый статус
+    attempts = event["attempts"] + 1
+    now = time.time()
+    if error is None:
+        status = "done"
+    elif attempts >= STRIPE_MAX_ATTEMPTS:
+        status = "failed"
+    else:
+        status = "pending"
+    with closing(_connect()) as conn:
+        conn.execute(
+            "UPDATE events SET status = ?, error = ?, processed_at = ?, available_at = ? WHERE id = ?",
+            (status, error, now, now + retry_delay(attempts), event["id"]),
+        )
+    return status
+
+def recover():
+    with closing(_connect()) as conn:
+        cur = conn.execute("UPDATE events SET status = 'pending' WHERE status = 'processing'")
+        if cur.rowcount:
+            print(f"[INBOX] requeued {cur.rowcount} interrupted event(s)")
+
+def purge():
+    global _last_purge
+    _last_purge = time.time()
+    cutoff = _last_purge - STRIPE_INBOX_RETENTION_DAYS * 86400
+    with closing(_connect()) as conn:
+        cur = conn.execute(
+            "DELETE FROM events WHERE status IN ('done', 'failed') AND received_at < ?", (cutoff,)
+        )
+        if cur.rowcount:
+            print(f"[INBOX] purged {cur.rowcount} event(s) older than {STRIPE_INBOX_RETENTION_DAYS:g} days")
+
+def stats():
+    with closing(_connect()) as conn:
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM events GROUP BY status").fetchall())
+    return {
+        "pending": counts.get("pending", 0),
+        "processing": counts.get("processing", 0),
+        "done": counts.get("done", 0),
+        "failed": counts.get("failed", 0),
+        "received": _counters["received"],
+        "duplicates": _counters["duplicates"],
+    }
+
+def _settle(event, result, describe=None):
+    # True — событие не обработалось
+    if not isinstance(result, BaseException):
+        _finish(event)
+        return False
+    what = describe(event) if describe else event["type"]
+    if _finish(event, error=str(result)) == "failed":
+        # Дальше событие само не обработается — нужен человек
+        logger.error(
+            "[INBOX] event %s (%s) failed permanently after %d attempts: %s",
+            event["id"], what, event["attempts"] + 1, result,
+        )
+    else:
+        print(f"[INBOX] event {event['id']} ({what}) failed:", result)
+    return True
+
+async def _consume(process_batch, describe):
+    while True:
+        if time.time() - _last_purge > 3600:
+            purge()
+        events = _claim_batch(STRIPE_BATCH_SIZE)
+        if not events:
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=STRIPE_INBOX_POLL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        # process_batch возвращает по результату на событие: None или исключение
+        try:
+            results = await process_batch(events)
+        except Exception as e:
+            results = [e] * len(events)
+        failed = sum(_settle(event, result, describe) for event, result in zip(events, results))
+        print(f"[INBOX] processed batch of {len(events)} event(s), {failed} failed")
+
+async def start_consumer(process_batch, describe=None):
+    # describe(event) — строка для логов, например tg_id и продукт заказа
+    global _consumer
+    recover()
+    _consumer = asyncio.create_task(_consume(process_batch, describe))
+
+async def stop_consumer():
+    global _consumer
+    if _consumer is not None:
+        _consumer.cancel()
+        await asyncio.gather(_consumer, return_exceptions=True)
+        _consumer = None
@@ -0,0 +1,41 @@
+# supabase_http.py
+# REST API Supabase (PostgREST для users_repo, Storage для storage) через httpx.AsyncClient
+# с ключом сервиса в заголовках и keep-alive.
+
+import os
+import httpx
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = (
+    os.getenv("SUPABASE_KEY") or
+    os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+)
+
+class SupabaseClient:
+    # Один клиент на API на процесс: создаётся при первом запросе, закрывается в close() при остановке
+    def __init__(self, path, timeout, max_connections):
+        self.base_url = f"{SUPABASE_URL}{path}"
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._client = None
+
+    def get(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={
+                    "apikey": SUPABASE_KEY,
+                    "Authorization": f"Bearer {SUPABASE_KEY}",
+                },
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+        self._client = None
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Модули бота лежат в корне репозитория, без пакета
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Клиенты создаются при импорте модулей; в тестах в сеть никто не ходит
+os.environ.setdefault("OPENAI_API_KEY", "test")
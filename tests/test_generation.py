@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+import generation
+import report_queue
+import report_store
+
+@pytest.fixture(autouse=True)
+def queue_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(report_queue, "REPORT_QUEUE_PATH", str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setattr(report_store, "REPORT_STORE_PATH", str(tmp_path / "reports.sqlite3"))
+
+class Bot:
+    def __init__(self):
+        self.deleted = []
+        self.messages = []
+
+    async def delete_message(self, chat_id, message_id):
+        self.deleted.append((chat_id, message_id))
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+
+class Application:
+    def __init__(self):
+        self.bot = Bot()
+
+def test_failure_before_delivery_notifies_waiting_chats(monkeypatch):
+    async def get_report_context(tg_id, product_type, fresh=False):
+        # Профиль без даты рождения — build_report_messages упадёт
+        return {"tg_id": tg_id, "name": "Кот"}
+
+    monkeypatch.setattr(generation.users_repo, "get_report_context", get_report_context)
+    job_id = report_queue.enqueue(1, "destiny", target={"chat_id": 7, "loading_message_id": 70})
+    job = report_queue._claim()
+    assert job["id"] == job_id
+
+    app = Application()
+    with pytest.raises(KeyError):
+        asyncio.run(generation.generate_and_send(app, job))
+    assert app.bot.deleted == [(7, 70)]
+    assert app.bot.messages == [(7, "Ошибка генерации. Попробуй позже.")]
+    assert report_queue.targets(job_id) == []
+
+def test_handler_delivery_joins_order_trace(monkeypatch):
+    spans = []
+    monkeypatch.setattr(generation.tracing, "_exporter", type("E", (), {"export": lambda self, span: spans.append(span)})())
+    monkeypatch.setattr(generation.report_queue, "last_trace_id", lambda tg_id, product_type: "cs_test_1")
+
+    class DocumentBot:
+        async def send_document(self, chat_id, document, caption, **kwargs):
+            return "sent"
+
+    user = {"tg_id": 1, "destiny_pdf_file_id": "file-1"}
+    assert asyncio.run(generation.send_report_document(DocumentBot(), 7, "destiny", user)) == "sent"
+    assert {s["name"] for s in spans} == {"delivery", "telegram_send"}
+    assert {s["trace_id"] for s in spans} == {"cs_test_1"}
+
+def test_failed_part_is_retried_without_the_finished_one(monkeypatch):
+    profile = {
+        "tg_id": 1, "name": "Кот", "birth_date": "2000-01-02", "birth_time": "12:00",
+        "birth_city": "Москва", "birth_country": "Россия",
+    }
+
+    async def get_report_context(tg_id, product_type, fresh=False):
+        return profile
+
+    asked = []
+    fail = {"part": "2"}
+
+    async def ask_gpt_async(messages, labels=None, on_text=None, **kwargs):
+        asked.append(labels["part"])
+        if labels["part"] == fail["part"]:
+            raise RuntimeError("gpt down")
+        return f"часть {labels['part']}"
+
+    async def render_pdf(text, product_type):
+        raise RuntimeError(text)
+
+    monkeypatch.setattr(generation.users_repo, "get_report_context", get_report_context)
+    monkeypatch.setattr(generation, "ask_gpt_async", ask_gpt_async)
+    monkeypatch.setattr(generation, "render_pdf", render_pdf)
+    app = Application()
+
+    report_queue.enqueue(1, "destiny")
+    with pytest.raises(generation.ReportGenerationError):
+        asyncio.run(generation.generate_and_send(app, report_queue._claim()))
+    assert sorted(asked) == ["1", "2"]
+
+    # Следующая попытка оплачивает только упавшую часть
+    asked.clear()
+    fail["part"] = None
+    report_queue.enqueue(1, "destiny", {"retry": True})
+    with pytest.raises(RuntimeError, match="часть 1\n\nчасть 2"):
+        asyncio.run(generation.generate_and_send(app, report_queue._claim()))
+    assert asked == ["2"]
+    messages_parts = generation.build_report_messages("destiny", profile, {})
+    assert report_store.load_parts(1, "destiny", messages_parts) is None
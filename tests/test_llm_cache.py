@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+import llm_cache
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(llm_cache, "LLM_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(llm_cache, "_total_bytes", None)
+
+def test_key_depends_on_model_messages_and_params():
+    messages = [{"role": "user", "content": "мяу"}]
+    key = llm_cache.make_key("gpt-4o", messages, max_tokens=100)
+    assert key == llm_cache.make_key("gpt-4o", list(messages), max_tokens=100)
+    assert key != llm_cache.make_key("gpt-4-turbo", messages, max_tokens=100)
+    assert key != llm_cache.make_key("gpt-4o", messages, max_tokens=200)
+
+def test_roundtrip_and_miss():
+    assert llm_cache.get("0" * 64) is None
+    llm_cache.put("a" * 64, "текст отчёта")
+    assert llm_cache.get("a" * 64) == "текст отчёта"
+
+def test_evicts_least_recently_used_over_limit(monkeypatch):
+    # Каждая запись ~3.4 КБ после сжатия: две помещаются в лимит 8 КБ, три — нет
+    monkeypatch.setattr(llm_cache, "LLM_CACHE_MAX_MB", 8 / 1024)
+    texts = {k: os.urandom(3000).hex() for k in ("a", "b", "c")}
+    llm_cache.put("a" * 64, texts["a"])
+    llm_cache.put("b" * 64, texts["b"])
+    os.utime(llm_cache._path("a" * 64), (1, 1))
+    os.utime(llm_cache._path("b" * 64), (2, 2))
+    llm_cache.put("c" * 64, texts["c"])
+    assert llm_cache.get("a" * 64) is None
+    assert llm_cache.get("c" * 64) == texts["c"]
@@ -0,0 +1,35 @@
+import socket
+import asyncio
+
+import httpx
+
+import metrics
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def test_register_stats_replaces_same_prefix():
+    metrics.register_stats("test_source", lambda: {"value": 1})
+    metrics.register_stats("test_source", lambda: {"value": 2})
+    lines = [line for line in metrics.render().splitlines() if line.startswith("astrobot_test_source_value")]
+    assert lines == ["astrobot_test_source_value 2"]
+
+def test_metrics_server_serves_render():
+    async def main():
+        port = _free_port()
+        await metrics.start_server("127.0.0.1", port)
+        try:
+            for _ in range(50):
+                try:
+                    async with httpx.AsyncClient() as client:
+                        resp = await client.get(f"http://127.0.0.1:{port}/metrics")
+                    break
+                except httpx.ConnectError:
+                    await asyncio.sleep(0.05)
+            assert resp.status_code == 200
+            assert "astrobot_report_stage_seconds" in resp.text
+        finally:
+            await metrics.stop_server()
+    asyncio.run(main())
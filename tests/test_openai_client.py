@@ -0,0 +1,98 @@
+import asyncio
+
+import httpx
+import openai
+
+import openai_client
+from openai_client import CircuitBreaker
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_breaker_opens_after_threshold_and_probes_once(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(openai_client.time, "monotonic", clock)
+    breaker = CircuitBreaker(threshold=2, cooldown=30)
+
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.wait_time() == 0
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.opens == 1
+    assert breaker.wait_time() == 30
+
+    clock.now += 30
+    # Кулдаун прошёл — пропускаем ровно один пробный запрос
+    assert breaker.wait_time() == 0
+    assert breaker.state == "half_open"
+    assert breaker.wait_time() > 0
+
+    # Проба упала — снова open на полный кулдаун
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.opens == 2
+
+    clock.now += 30
+    assert breaker.wait_time() == 0
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.failures == 0
+
+def test_retries_retryable_errors_then_succeeds(monkeypatch):
+    monkeypatch.setattr(openai_client, "breaker", CircuitBreaker(threshold=5, cooldown=30))
+    monkeypatch.setattr(openai_client, "OPENAI_BACKOFF_BASE", 0)
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    calls = []
+
+    async def call():
+        calls.append(1)
+        if len(calls) < 3:
+            raise openai.APIConnectionError(request=request)
+        return "ok"
+
+    assert asyncio.run(openai_client._call_with_retries(call)) == "ok"
+    assert len(calls) == 3
+    assert openai_client.breaker.state == "closed"
+
+def test_does_not_retry_bad_request(monkeypatch):
+    monkeypatch.setattr(openai_client, "breaker", CircuitBreaker(threshold=5, cooldown=30))
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(400, request=request)
+    calls = []
+
+    async def call():
+        calls.append(1)
+        raise openai.BadRequestError("bad", response=response, body=None)
+
+    try:
+        asyncio.run(openai_client._call_with_retries(call))
+    except openai.BadRequestError:
+        pass
+    else:
+        raise AssertionError("BadRequestError expected")
+    assert len(calls) == 1
+    assert openai_client.breaker.failures == 0
+
+def test_open_breaker_fails_fast(monkeypatch):
+    breaker = CircuitBreaker(threshold=1, cooldown=30)
+    breaker.record_failure()
+    monkeypatch.setattr(openai_client, "breaker", breaker)
+    calls = []
+
+    async def call():
+        calls.append(1)
+        return "ok"
+
+    async def main():
+        start = asyncio.get_running_loop().time()
+        try:
+            await openai_client._call_with_retries(call)
+        except openai_client.CircuitOpenError:
+            pass
+        else:
+            raise AssertionError("CircuitOpenError expected")
+        # Не ждали кулдаун и в OpenAI не ходили
+        assert asyncio.get_running_loop().time() - start < 0.1
+    asyncio.run(main())
+    assert calls == []
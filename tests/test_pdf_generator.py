@@ -0,0 +1,54 @@
+import os
+import re
+import signal
+import asyncio
+
+from reportlab.pdfbase import pdfdoc
+
+import pdf_generator
+
+def test_render_pool_restarts_after_worker_dies(monkeypatch):
+    monkeypatch.setattr(pdf_generator, "PDF_RENDER_WORKERS", 1)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        await pdf_generator.warm_render_pool()
+        broken = pdf_generator.get_render_pool()
+        pid = await loop.run_in_executor(broken, pdf_generator._render_worker_ready, 0)
+        os.kill(pid, signal.SIGKILL)
+        try:
+            pdf = await pdf_generator.render_pdf("## Заголовок\nТекст", product_type="destiny")
+            assert pdf.startswith(b"%PDF")
+            assert pdf_generator.get_render_pool() is not broken
+        finally:
+            pdf_generator.shutdown_render_pool()
+    asyncio.run(main())
+
+def _image_xobjects(pdf):
+    return len(re.findall(rb"/Subtype /Image\b", pdf))
+
+def test_cached_images_are_not_reencoded(monkeypatch):
+    # CachedImage подкладывает готовый XObject через внутренности ReportLab. Если после
+    # обновления ReportLab трюк перестанет срабатывать, drawImage снова начнёт кодировать PNG
+    text = "\n".join(f"## {header}\n" + "Текст раздела. " * 200 for header in pdf_generator.DESTINY_HEADERS)
+    pdf_generator.text_to_pdf(text, product_type="destiny")
+    images = [
+        pdf_generator.get_cached_image(pdf_generator.LOGO_PATH),
+        pdf_generator.get_cached_image(pdf_generator.get_cat_avatar_path("destiny")),
+    ]
+    expected = sum(1 + (getattr(image.xobject, "_smask", None) is not None) for image in images)
+
+    encoded = []
+    init = pdfdoc.PDFImageXObject.__init__
+
+    def counting_init(self, *args, **kwargs):
+        encoded.append(args[0] if args else None)
+        init(self, *args, **kwargs)
+
+    monkeypatch.setattr(pdfdoc.PDFImageXObject, "__init__", counting_init)
+    for _ in range(2):
+        pdf = pdf_generator.text_to_pdf(text, product_type="destiny")
+        # Водяной знак на каждой странице — один и тот же объект
+        assert int(re.search(rb"/Count (\d+)", pdf).group(1)) > 1
+        assert _image_xobjects(pdf) == expected
+    assert encoded == []
@@ -0,0 +1,45 @@
+import asyncio
+
+from rate_limiter import TokenBucketScheduler, PRIORITY_HIGH, PRIORITY_LOW
+
+def test_grants_immediately_within_budget():
+    async def main():
+        limiter = TokenBucketScheduler(rpm=60, tpm=6000)
+        assert await limiter.acquire(1000) < 0.1
+        assert limiter.stats()["granted"] == 1
+    asyncio.run(main())
+
+def test_high_priority_overtakes_low_waiting_for_refill():
+    async def main():
+        limiter = TokenBucketScheduler(rpm=60, tpm=6000)
+        await limiter.acquire(5000, PRIORITY_HIGH)
+        # 3000 токенов нет — LOW встаёт в голову очереди и ждёт таймер пополнения (~20 с)
+        low = asyncio.create_task(limiter.acquire(3000, PRIORITY_LOW))
+        await asyncio.sleep(0)
+        assert limiter.stats()["waiting_low"] == 1
+        # Бюджет на 1000 есть — HIGH не должен ждать таймера LOW
+        waited = await asyncio.wait_for(limiter.acquire(1000, PRIORITY_HIGH), timeout=1)
+        assert waited < 1
+        assert not low.done()
+        low.cancel()
+        await asyncio.gather(low, return_exceptions=True)
+        assert limiter.stats()["waiting"] == 0
+    asyncio.run(main())
+
+def test_waiters_do_not_overtake_within_priority():
+    async def main():
+        limiter = TokenBucketScheduler(rpm=0, tpm=60000)
+        await limiter.acquire(59000)
+        order = []
+
+        async def acquire(name, tokens):
+            await limiter.acquire(tokens)
+            order.append(name)
+
+        # Крупный ждёт пополнения (~1 с); мелкий того же приоритета его не обгоняет
+        big = asyncio.create_task(acquire("big", 2000))
+        await asyncio.sleep(0)
+        small = asyncio.create_task(acquire("small", 100))
+        await asyncio.wait_for(asyncio.gather(big, small), timeout=3)
+        assert order == ["big", "small"]
+    asyncio.run(main())
@@ -0,0 +1,35 @@
+import asyncio
+
+import generation
+from generation import ReportProgress
+
+class Bot:
+    def __init__(self):
+        self.captions = []
+
+    async def edit_message_caption(self, chat_id, message_id, caption):
+        self.captions.append(caption)
+
+def test_progress_scans_text_at_most_once_per_interval(monkeypatch):
+    monkeypatch.setattr(generation.report_queue, "targets", lambda job_id: [{"chat_id": 1, "loading_message_id": 2}])
+    headers = generation.get_headers_for_product("destiny")
+
+    async def main():
+        bot = Bot()
+        progress = ReportProgress(bot, job_id=1, product_type="destiny", parts=2)
+        scans = []
+        completed = progress.completed
+        monkeypatch.setattr(progress, "completed", lambda: scans.append(1) or completed())
+
+        # Первый раздел уже дописан, второй пишется
+        text = f"{headers[0]}\nмяу\n{headers[1]}\n"
+        for _ in range(300):
+            text += "мяу "
+            progress.update(0, text)
+        await progress.close()
+        return bot, scans
+
+    bot, scans = asyncio.run(main())
+    # 300 фрагментов подряд — текст пересчитан один раз, подпись изменена один раз
+    assert len(scans) == 1
+    assert len(bot.captions) == 1
@@ -0,0 +1,38 @@
+from contextlib import closing
+
+import pytest
+
+import report_queue
+
+@pytest.fixture(autouse=True)
+def queue_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(report_queue, "REPORT_QUEUE_PATH", str(tmp_path / "jobs.sqlite3"))
+
+def test_same_inputs_attach_to_one_job():
+    first = report_queue.enqueue(1, "destiny", target={"chat_id": 1, "loading_message_id": 10})
+    second = report_queue.enqueue(1, "destiny", target={"chat_id": 1, "loading_message_id": 11})
+    other = report_queue.enqueue(1, "compatibility", {"partner": "x"}, target={"chat_id": 1})
+    assert first == second != other
+    assert [t["loading_message_id"] for t in report_queue.targets(first)] == [10, 11]
+
+def test_recover_does_not_redeliver_sealed_targets():
+    job_id = report_queue.enqueue(1, "destiny", target={"chat_id": 1, "loading_message_id": 10})
+    assert report_queue._claim()["id"] == job_id
+    assert report_queue.seal(job_id) == [{"chat_id": 1, "loading_message_id": 10}]
+
+    # Процесс упал посреди отправки — задача вернётся в очередь без получателей
+    report_queue.recover()
+    job = report_queue._claim()
+    assert job["id"] == job_id
+    assert job["targets"] == []
+
+def test_last_trace_id_is_latest_job_of_product():
+    assert report_queue.last_trace_id(1, "destiny") is None
+    first = report_queue.enqueue(1, "destiny")
+    report_queue.enqueue(1, "solyar")
+    assert report_queue._claim()["id"] == first
+    report_queue._finish(first, "done")
+    second = report_queue.enqueue(1, "destiny", {"again": True})
+    with closing(report_queue._connect()) as conn:
+        expected = conn.execute("SELECT trace_id FROM jobs WHERE id = ?", (second,)).fetchone()["trace_id"]
+    assert report_queue.last_trace_id(1, "destiny") == expected
@@ -0,0 +1,22 @@
+import pytest
+
+import report_store
+
+@pytest.fixture(autouse=True)
+def store_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(report_store, "REPORT_STORE_PATH", str(tmp_path / "reports.sqlite3"))
+    monkeypatch.setattr(report_store, "_last_purge", 0.0)
+
+def test_purge_removes_old_texts(monkeypatch):
+    messages = [[{"role": "user", "content": "старый"}]]
+    report_store.save(1, "destiny", messages, "старый текст")
+    report_store.save_parts(1, "destiny", messages, ["часть", None])
+
+    now = report_store.time.time() + (report_store.REPORT_STORE_RETENTION_DAYS + 1) * 86400
+    monkeypatch.setattr(report_store.time, "time", lambda: now)
+    fresh = [[{"role": "user", "content": "новый"}]]
+    # Первый save после часа без очистки удаляет тексты старше срока хранения
+    report_store.save(1, "destiny", fresh, "новый текст")
+    assert report_store.load(1, "destiny", messages) is None
+    assert report_store.load_parts(1, "destiny", messages) is None
+    assert report_store.load(1, "destiny", fresh) == "новый текст"
@@ -0,0 +1,35 @@
+import logging
+
+import pytest
+
+import stripe_inbox
+
+@pytest.fixture(autouse=True)
+def inbox_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(stripe_inbox, "STRIPE_INBOX_PATH", str(tmp_path / "inbox.sqlite3"))
+
+def test_retry_delay_is_capped():
+    delays = [stripe_inbox.retry_delay(a) for a in range(1, stripe_inbox.STRIPE_MAX_ATTEMPTS)]
+    assert delays[0] == stripe_inbox.STRIPE_RETRY_DELAY
+    assert max(delays) == stripe_inbox.STRIPE_RETRY_MAX_DELAY
+    # Оплаченный заказ переживает многочасовой простой Supabase
+    assert sum(delays) > 12 * 3600
+
+def test_failed_event_is_retried_then_logged(monkeypatch, caplog):
+    monkeypatch.setattr(stripe_inbox, "STRIPE_MAX_ATTEMPTS", 2)
+    assert stripe_inbox.add("evt_1", "checkout.session.completed", "{}")
+    describe = lambda event: "tg_id=1, product=destiny"
+    error = RuntimeError("supabase down")
+
+    event = stripe_inbox._claim_batch(10)[0]
+    assert stripe_inbox._settle(event, error, describe)
+    # Повтор ещё не наступил
+    assert stripe_inbox._claim_batch(10) == []
+    assert stripe_inbox.stats()["pending"] == 1
+
+    monkeypatch.setattr(stripe_inbox.time, "time", lambda: 10 ** 10)
+    event = stripe_inbox._claim_batch(10)[0]
+    with caplog.at_level(logging.ERROR, logger="stripe_inbox"):
+        assert stripe_inbox._settle(event, error, describe)
+    assert stripe_inbox.stats()["failed"] == 1
+    assert "tg_id=1, product=destiny" in caplog.text
@@ -0,0 +1,57 @@
+import asyncio
+
+from telegram import Chat, Message, Update, User
+
+from update_processor import PerChatUpdateProcessor
+
+def _update(update_id, chat_id):
+    user = User(id=chat_id, first_name="u", is_bot=False)
+    chat = Chat(id=chat_id, type=Chat.PRIVATE)
+    message = Message(message_id=update_id, date=None, chat=chat, from_user=user, text="x")
+    return Update(update_id=update_id, message=message)
+
+def test_same_chat_in_order_other_chats_concurrent():
+    async def main():
+        processor = PerChatUpdateProcessor(16)
+        log = []
+
+        async def handle(name, delay):
+            log.append(("start", name))
+            await asyncio.sleep(delay)
+            log.append(("end", name))
+
+        await asyncio.gather(
+            processor.process_update(_update(1, 100), handle("a1", 0.05)),
+            processor.process_update(_update(2, 100), handle("a2", 0)),
+            processor.process_update(_update(3, 200), handle("b1", 0)),
+        )
+        # Второй апдейт чата 100 начался только после первого
+        assert log.index(("end", "a1")) < log.index(("start", "a2"))
+        # Чат 200 не ждал чат 100
+        assert log.index(("end", "b1")) < log.index(("end", "a1"))
+        assert processor._queues == {}
+    asyncio.run(main())
+
+def test_busy_chat_does_not_hold_global_slots():
+    async def main():
+        # Чат 100 прислал больше апдейтов, чем общих слотов
+        processor = PerChatUpdateProcessor(2)
+        done = {}
+
+        async def handle(name, delay):
+            await asyncio.sleep(delay)
+            done[name] = asyncio.get_running_loop().time()
+
+        start = asyncio.get_running_loop().time()
+        tasks = [
+            asyncio.create_task(processor.process_update(_update(i, 100), handle(f"a{i}", 0.1)))
+            for i in range(6)
+        ]
+        await asyncio.sleep(0)
+        await processor.process_update(_update(10, 200), handle("b", 0))
+        # Чат 200 не стоял за очередью чата 100
+        assert done["b"] - start < 0.05
+        await asyncio.gather(*tasks)
+        assert [name for name in sorted(done, key=done.get) if name != "b"] == [f"a{i}" for i in range(6)]
+        assert processor._queues == {}
+    asyncio.run(main())
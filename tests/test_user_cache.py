@@ -0,0 +1,32 @@
+from user_cache import UserCache
+import user_cache
+
+def test_ttl_expiry(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(user_cache.time, "monotonic", lambda: now[0])
+    cache = UserCache(ttl=60, max_size=10)
+    cache.put(1, {"name": "a"})
+    assert cache.get(1) == {"name": "a"}
+    now[0] += 61
+    assert cache.get(1) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+def test_evicts_least_recently_used():
+    cache = UserCache(ttl=60, max_size=2)
+    cache.put(1, "a")
+    cache.put(2, "b")
+    cache.get(1)
+    cache.put(3, "c")
+    assert cache.get(2) is None
+    assert cache.get(1) == "a" and cache.get(3) == "c"
+    assert cache.stats()["evictions"] == 1
+
+def test_put_after_invalidate_during_read_is_dropped():
+    cache = UserCache(ttl=60, max_size=10)
+    token = cache.begin(1)
+    # Пока читали из базы, строку обновили — прочитанное уже устарело
+    cache.invalidate(1)
+    cache.put(1, "stale", token)
+    assert cache.get(1) is None
+    cache.put(1, "fresh", cache.begin(1))
+    assert cache.get(1) == "fresh"
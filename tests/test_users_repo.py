@@ -0,0 +1,37 @@
+import asyncio
+
+import httpx
+
+import users_repo
+
+def test_reads_without_missing_file_id_column(monkeypatch):
+    requests = []
+
+    def handler(request):
+        select = request.url.params["select"]
+        requests.append(select)
+        if "destiny_pdf_file_id" in select:
+            return httpx.Response(400, json={
+                "code": "42703", "message": "column users.destiny_pdf_file_id does not exist",
+            })
+        return httpx.Response(200, json=[{"tg_id": 1, "paid_destiny": True, "destiny_pdf_url": "u"}])
+
+    async def main():
+        client = httpx.AsyncClient(base_url="http://supabase/rest/v1", transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(users_repo, "_get_client", lambda: client)
+        monkeypatch.setattr(users_repo, "_missing_columns", set())
+        first = await users_repo.get_entitlements(1, "destiny", fresh=True)
+        second = await users_repo.get_entitlements(1, "destiny", fresh=True)
+        await client.aclose()
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first == second == {
+        "tg_id": 1, "paid_destiny": True, "destiny_pdf_url": "u", "destiny_pdf_file_id": None,
+    }
+    # Колонку запоминаем: второй запрос сразу без неё
+    assert requests == [
+        "tg_id,paid_destiny,destiny_pdf_url,destiny_pdf_file_id",
+        "tg_id,paid_destiny,destiny_pdf_url",
+        "tg_id,paid_destiny,destiny_pdf_url",
+    ]
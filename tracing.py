@@ -0,0 +1,250 @@
+# tracing.py
+# Трассировка заказа: webhook Stripe → очередь → GPT → PDF → storage → Telegram.
+# trace_id оплаченного заказа — id checkout-сессии Stripe, он едет в задаче report_queue
+# и виден во всех спанах. Спаны пишутся JSON-строками в TRACE_PATH (или в свой экспортёр).
+# Вне трассы span() ничего не делает — обычные запросы бота трассировка не трогает.
+#
+# Критический путь заказа:
+#   python tracing.py cs_live_...
+#   python tracing.py --tg-id 123456 --product destiny   (последний заказ пользователя)
+
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import importlib
+import threading
+import contextvars
+from contextlib import contextmanager
+
+TRACE_PATH = os.getenv(
+    "TRACE_PATH",
+    os.path.join(os.path.dirname(__file__), "data", "traces.jsonl"),
+)
+TRACE_MAX_MB = float(os.getenv("TRACE_MAX_MB", "50"))
+# jsonl (по умолчанию), none или "модуль:фабрика", которая возвращает объект с методом export(span)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "jsonl")
+# Соседние спаны на критическом пути могут перекрываться на столько секунд:
+# enqueue идёт внутри webhook.fulfill, а часы bot и webhook расходятся
+CRITICAL_PATH_SLACK = float(os.getenv("CRITICAL_PATH_SLACK", "0.05"))
+
+# (trace_id, span_id текущего спана или None)
+_current = contextvars.ContextVar("trace_context", default=None)
+
+class JsonLinesExporter:
+    # Дописывает спаны в файл; bot и webhook могут писать в один и тот же файл.
+    # Больше TRACE_MAX_MB — файл уезжает в .1, старая .1 удаляется
+    def __init__(self, path=TRACE_PATH, max_mb=TRACE_MAX_MB):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError as e:
+                print("[TRACE] write error:", e)
+
+class NullExporter:
+    def export(self, span):
+        pass
+
+def _load_exporter(spec):
+    if spec == "jsonl":
+        return JsonLinesExporter()
+    if spec == "none":
+        return NullExporter()
+    module, _, factory = spec.partition(":")
+    return getattr(importlib.import_module(module), factory)()
+
+_exporter = None
+
+def get_exporter():
+    global _exporter
+    if _exporter is None:
+        _exporter = _load_exporter(TRACE_EXPORTER)
+    return _exporter
+
+def set_exporter(exporter):
+    global _exporter
+    _exporter = exporter
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+def current_trace_id():
+    ctx = _current.get()
+    return ctx[0] if ctx else None
+
+@contextmanager
+def trace(trace_id):
+    # Всё, что выполняется внутри (включая задачи из asyncio.gather), попадает в trace_id.
+    # trace_id=None — не трассируем (например, событие Stripe без checkout-сессии)
+    if not trace_id:
+        yield None
+        return
+    token = _current.set((trace_id, None))
+    try:
+        yield trace_id
+    finally:
+        _current.reset(token)
+
+def _export(trace_id, parent_id, span_id, name, start, end, status, error, attrs):
+    try:
+        get_exporter().export({
+            "trace_id": trace_id,
+            "span_id": span_id,
+            "parent_id": parent_id,
+            "name": name,
+            "start": start,
+            "end": end,
+            "duration": end - start,
+            "status": status,
+            "error": error,
+            "attrs": attrs,
+        })
+    except Exception as e:
+        print("[TRACE] export error:", e)
+
+@contextmanager
+def span(name, **attrs):
+    # Внутри можно дописать атрибуты: with span("x") as attrs: attrs["hit"] = True
+    ctx = _current.get()
+    if ctx is None:
+        yield attrs
+        return
+    trace_id, parent_id = ctx
+    span_id = uuid.uuid4().hex[:16]
+    token = _current.set((trace_id, span_id))
+    start = time.time()
+    status, error = "ok", None
+    try:
+        yield attrs
+    except BaseException as e:
+        status, error = "error", f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        _export(trace_id, parent_id, span_id, name, start, time.time(), status, error, attrs)
+
+def record_span(name, start, end, trace_id=None, **attrs):
+    # Спан задним числом — например, ожидание в очереди между enqueue и запуском воркера
+    ctx = _current.get()
+    trace_id = trace_id or (ctx[0] if ctx else None)
+    if trace_id is None:
+        return
+    parent_id = ctx[1] if ctx and ctx[0] == trace_id else None
+    _export(trace_id, parent_id, uuid.uuid4().hex[:16], name, start, end, "ok", None, attrs)
+
+def read_spans(path=TRACE_PATH):
+    spans = []
+    for p in (path + ".1", path):
+        if not os.path.exists(p):
+            continue
+        with open(p, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    continue
+    return spans
+
+def critical_path(spans):
+    # Идём от конца трассы назад: на каждом уровне берём спан, который закончился последним,
+    # затем тот, что закончился до его начала, и т.д.; внутри спана — то же по его детям.
+    # Возвращает [(span, depth)] в хронологическом порядке
+    ids = {s["span_id"] for s in spans}
+    children = {}
+    for s in spans:
+        parent = s["parent_id"] if s["parent_id"] in ids else None
+        children.setdefault(parent, []).append(s)
+
+    def walk(parent, end, depth):
+        chain = []
+        until = end
+        for s in sorted(children.get(parent, ()), key=lambda s: s["end"], reverse=True):
+            if s["end"] <= until + CRITICAL_PATH_SLACK and s["start"] < until:
+                chain.append(s)
+                until = s["start"]
+        path = []
+        for s in reversed(chain):
+            path.append((s, depth))
+            path.extend(walk(s["span_id"], s["end"], depth + 1))
+        return path
+
+    return walk(None, max((s["end"] for s in spans), default=0), 0)
+
+def _find_trace(spans, tg_id, product_type=None):
+    # Последняя трасса, в которой есть спан с этим пользователем (и продуктом)
+    latest = {}
+    for s in spans:
+        attrs = s.get("attrs") or {}
+        if str(attrs.get("tg_id")) != str(tg_id):
+            continue
+        if product_type and attrs.get("product") != product_type:
+            continue
+        latest[s["trace_id"]] = max(latest.get(s["trace_id"], 0), s["end"])
+    return max(latest, key=latest.get) if latest else None
+
+def print_critical_path(trace_spans, out=sys.stdout):
+    start = min(s["start"] for s in trace_spans)
+    end = max(s["end"] for s in trace_spans)
+    path = critical_path(trace_spans)
+    print(f"Trace {trace_spans[0]['trace_id']}: {end - start:.3f}s, {len(trace_spans)} spans", file=out)
+    print("Critical path:", file=out)
+
+    # Собственное время спана на пути — без детей, которые тоже на пути
+    own = {}
+    for i, (s, depth) in enumerate(path):
+        nested = 0.0
+        for child, child_depth in path[i + 1:]:
+            if child_depth <= depth:
+                break
+            if child_depth == depth + 1:
+                nested += child["duration"]
+        own[s["span_id"]] = s["duration"] - nested
+
+    for s, depth in path:
+        attrs = ", ".join(f"{k}={v}" for k, v in (s.get("attrs") or {}).items())
+        status = "" if s["status"] == "ok" else f"  [{s['error']}]"
+        print(
+            f"  +{s['start'] - start:8.3f}s {s['duration']:8.3f}s  {'  ' * depth}{s['name']}"
+            + (f" ({attrs})" if attrs else "") + status,
+            file=out,
+        )
+
+    print("Slowest stages on the path (own time):", file=out)
+    for s, _ in sorted(path, key=lambda item: own[item[0]["span_id"]], reverse=True)[:5]:
+        print(f"  {own[s['span_id']]:8.3f}s  {s['name']}", file=out)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Критический путь заказа по трассам")
+    parser.add_argument("trace_id", nargs="?", help="id checkout-сессии Stripe или trace_id задачи")
+    parser.add_argument("--tg-id", help="последний заказ пользователя")
+    parser.add_argument("--product", help="продукт для --tg-id")
+    parser.add_argument("--path", default=TRACE_PATH)
+    args = parser.parse_args(argv)
+
+    spans = read_spans(args.path)
+    trace_id = args.trace_id
+    if trace_id is None:
+        if args.tg_id is None:
+            parser.error("нужен trace_id или --tg-id")
+        trace_id = _find_trace(spans, args.tg_id, args.product)
+    trace_spans = [s for s in spans if s["trace_id"] == trace_id]
+    if not trace_spans:
+        print(f"No spans for trace {trace_id}")
+        return 1
+    print_critical_path(trace_spans)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+# update_processor.py
+# Апдейты разных чатов обрабатываются параллельно, апдейты одного чата — строго по очереди.
+# ConversationHandler хранит состояние диалога по чату/пользователю и рассчитывает,
+# что два сообщения одного пользователя не обрабатываются одновременно.
+
+from collections import deque
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+def _update_key(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return ("user", update.effective_user.id)
+    return None
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # PTB берёт общий слот (max_concurrent_updates) до do_process_update. Апдейт чата,
+    # который уже обрабатывается, не ждёт со слотом, а встаёт в очередь чата и сразу
+    # отпускает слот; очередь разбирает тот, кто обрабатывает чат. Так чат занимает
+    # не больше одного слота, сколько бы апдейтов он ни прислал
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._queues = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = _update_key(update)
+        if key is None:
+            await coroutine
+            return
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(coroutine)
+            return
+        queue = self._queues[key] = deque()
+        try:
+            while True:
+                try:
+                    await coroutine
+                except Exception as e:
+                    # Ошибка одного апдейта не должна останавливать очередь чата
+                    print(f"[UPDATES] chat {key}: {type(e).__name__}: {e}")
+                if not queue:
+                    break
+                coroutine = queue.popleft()
+        finally:
+            del self._queues[key]
+            # Отменили посреди очереди (остановка бота) — остальное уже не выполнится
+            for pending in queue:
+                pending.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,66 @@
+# user_cache.py
+
+import time
+import threading
+from collections import OrderedDict
+
+class UserCache:
+    # Read-through кэш строк users по tg_id: TTL + вытеснение самых давно
+    # использованных записей, когда кэш переполнен
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._rows = OrderedDict()
+        self._invalidated_at = OrderedDict()
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, tg_id):
+        with self._lock:
+            entry = self._rows.get(tg_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._rows[tg_id]
+                self.misses += 1
+                return None
+            self._rows.move_to_end(tg_id)
+            self.hits += 1
+            return entry[1]
+
+    def begin(self, tg_id):
+        # Метка перед походом в базу: если запись инвалидируют, пока мы читаем, put() её не сохранит
+        with self._lock:
+            return self._epoch
+
+    def put(self, tg_id, value, token=None):
+        with self._lock:
+            if token is not None and self._invalidated_at.get(tg_id, -1) >= token:
+                return
+            self._rows[tg_id] = (time.monotonic() + self.ttl, value)
+            self._rows.move_to_end(tg_id)
+            while len(self._rows) > self.max_size:
+                self._rows.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, tg_id):
+        with self._lock:
+            self._rows.pop(tg_id, None)
+            self._invalidated_at[tg_id] = self._epoch
+            self._invalidated_at.move_to_end(tg_id)
+            if len(self._invalidated_at) > self.max_size:
+                self._invalidated_at.popitem(last=False)
+            self._epoch += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._rows),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else None,
+            }
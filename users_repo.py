@@ -0,0 +1,142 @@
+# users_repo.py
+# Асинхронный доступ к таблице users через PostgREST Supabase.
+# Каждый метод выбирает только нужные ему колонки; все запросы идут через
+# один httpx.AsyncClient с keep-alive, поэтому event loop бота не блокируется.
+
+import os
+from supabase_http import SupabaseClient
+from user_cache import UserCache
+import metrics
+import tracing
+
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "10"))
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "20"))
+
+PRODUCT_TYPES = ("destiny", "solyar", "blocks", "income", "compatibility")
+PROFILE_COLUMNS = ("id", "tg_id", "name", "birth_date", "birth_time", "birth_city", "birth_country")
+
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+# Значение — словарь уже прочитанных колонок пользователя, докачиваем недостающие
+user_cache = UserCache(ttl=USER_CACHE_TTL, max_size=USER_CACHE_SIZE)
+# Пользователя нет в базе — тоже кэшируем, чтобы /start не ходил в базу дважды
+_NO_USER = {"__missing__": True}
+
+_supabase = SupabaseClient("/rest/v1", SUPABASE_TIMEOUT, SUPABASE_MAX_CONNECTIONS)
+_get_client = _supabase.get
+close = _supabase.close
+# Колонки *_pdf_file_id добавляет migrations/001_users_pdf_file_id.sql. Пока миграция
+# не применена, читаем без них: file_id = None, и отчёт уходит по *_pdf_url
+_missing_columns = set()
+
+def entitlement_columns(product_type):
+    if product_type not in PRODUCT_TYPES:
+        raise ValueError(f"Unknown product_type: {product_type}")
+    return ("tg_id", f"paid_{product_type}", f"{product_type}_pdf_url", f"{product_type}_pdf_file_id")
+
+def _missing_file_id_column(resp, columns):
+    # PostgREST отвечает 400 с кодом Postgres 42703 «column users.x does not exist»
+    if resp.status_code != 400:
+        return None
+    try:
+        error = resp.json()
+    except ValueError:
+        return None
+    if error.get("code") != "42703":
+        return None
+    message = error.get("message") or ""
+    for column in columns:
+        if column.endswith("_pdf_file_id") and column in message:
+            return column
+    return None
+
+async def _select(tg_id, columns):
+    query = [c for c in columns if c not in _missing_columns]
+    with metrics.SUPABASE_SECONDS.time(op="select"), tracing.span("supabase.select", tg_id=tg_id):
+        resp = await _get_client().get(
+            "/users",
+            params={"select": ",".join(query), "tg_id": f"eq.{tg_id}", "limit": 1},
+        )
+    missing = _missing_file_id_column(resp, query)
+    if missing:
+        print(f"[USERS] column {missing} is missing, apply migrations/001_users_pdf_file_id.sql")
+        _missing_columns.add(missing)
+        return await _select(tg_id, columns)
+    resp.raise_for_status()
+    rows = resp.json()
+    if not rows:
+        return None
+    return {**{c: None for c in columns if c in _missing_columns}, **rows[0]}
+
+async def _update(tg_id, values):
+    try:
+        with metrics.SUPABASE_SECONDS.time(op="update"), tracing.span("supabase.update", tg_id=tg_id):
+            resp = await _get_client().patch(
+                "/users",
+                params={"tg_id": f"eq.{tg_id}"},
+                json=values,
+                headers={"Prefer": "return=minimal"},
+            )
+        resp.raise_for_status()
+    finally:
+        user_cache.invalidate(tg_id)
+
+async def get_columns(tg_id, columns, fresh=False):
+    cached = None if fresh else user_cache.get(tg_id)
+    if cached is _NO_USER:
+        return None
+    if cached is not None and all(c in cached for c in columns):
+        return {c: cached[c] for c in columns}
+
+    token = user_cache.begin(tg_id)
+    row = await _select(tg_id, columns)
+    if row is None:
+        user_cache.put(tg_id, _NO_USER, token)
+        return None
+    user_cache.put(tg_id, {**(cached or {}), **row}, token)
+    return row
+
+async def get_profile(tg_id, fresh=False):
+    return await get_columns(tg_id, PROFILE_COLUMNS, fresh=fresh)
+
+async def get_payment(tg_id, product_type, fresh=False):
+    # Только флаг оплаты — webhook'у не нужны колонки PDF (у blocks их и нет)
+    return await get_columns(tg_id, entitlement_columns(product_type)[:2], fresh=fresh)
+
+async def get_entitlements(tg_id, product_type, fresh=False):
+    return await get_columns(tg_id, entitlement_columns(product_type), fresh=fresh)
+
+async def get_report_context(tg_id, product_type, fresh=False):
+    # Профиль + состояние отчёта одним запросом — для воркера генерации
+    columns = PROFILE_COLUMNS + entitlement_columns(product_type)[1:]
+    return await get_columns(tg_id, columns, fresh=fresh)
+
+async def create_user(tg_id, name):
+    try:
+        with metrics.SUPABASE_SECONDS.time(op="insert"), tracing.span("supabase.insert", tg_id=tg_id):
+            resp = await _get_client().post(
+                "/users",
+                json={"tg_id": tg_id, "name": name},
+                headers={"Prefer": "return=minimal"},
+            )
+        resp.raise_for_status()
+    finally:
+        user_cache.invalidate(tg_id)
+
+async def update_profile(tg_id, **fields):
+    unknown = set(fields) - set(PROFILE_COLUMNS)
+    if unknown:
+        raise ValueError(f"Not profile columns: {sorted(unknown)}")
+    await _update(tg_id, fields)
+
+async def set_pdf_url(tg_id, product_type, url):
+    await _update(tg_id, {entitlement_columns(product_type)[2]: url})
+
+async def set_pdf_file_id(tg_id, product_type, file_id):
+    column = entitlement_columns(product_type)[3]
+    if column in _missing_columns:
+        return
+    await _update(tg_id, {column: file_id})
+
+async def mark_paid(tg_id, product_type):
+    await _update(tg_id, {entitlement_columns(product_type)[1]: True})
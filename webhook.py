@@ -1,7 +1,22 @@
 import os
+import json
+import time
+import asyncio
+from contextlib import asynccontextmanager
+
 import stripe
-from flask import Flask, request
-from supabase_client import get_user, update_user
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+
+import stripe_inbox
+import users_repo
+import metrics
+import tracing
+from report_queue import enqueue as enqueue_report
+from stripe_client import forget_checkout
 
 PRODUCTS = {
     "destiny": "paid_destiny",
@@ -11,70 +26,140 @@ PRODUCTS = {
     "compatibility": "paid_compatibility"
     # Добавь другие продукты при необходимости
 }
+# Эти отчёты можно сгенерировать сразу после оплаты. Совместимости нужны данные партнёра,
+# их пользователь вводит уже после оплаты — её генерирует бот.
+PREGENERATE_PRODUCTS = ("destiny", "solyar", "income")
 
 WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 
-app = Flask(__name__)
+async def apply_payment(tg_id, product_type):
+    # Сетевые ошибки не глотаем: событие останется в inbox и будет обработано повторно
+    user = await users_repo.get_payment(tg_id, product_type, fresh=True)
+    if not user:
+        print(f"[WEBHOOK] User with tg_id={tg_id} NOT FOUND in supabase. Update skipped!")
+        return False
+    if not user.get(PRODUCTS[product_type]):
+        with metrics.STAGE_SECONDS.time(stage="mark_paid", product=product_type):
+            await users_repo.mark_paid(tg_id, product_type)
+    print(f"[WEBHOOK] mark_paid ok: tg_id={tg_id}, {product_type}")
+    return True
 
-@app.route("/stripe/webhook", methods=["POST"])
-def stripe_webhook():
-    payload = request.data
-    sig_header = request.headers.get("stripe-signature")
-    print("=== STRIPE WEBHOOK RAW PAYLOAD ===")
+def parse_checkout_session(session):
+    # Возвращает (tg_id, product_type) или None, если в metadata нет нужных данных
+    metadata = session.get("metadata") or {}
+    tg_id_raw = metadata.get("tg_id")
+    if not tg_id_raw:
+        print(f"[WEBHOOK] No tg_id in metadata of session {session.get('id')}! Cannot continue.")
+        return None
     try:
-        print(payload.decode())
-    except Exception:
-        print("[WEBHOOK] Could not decode payload as utf-8.")
-    print("=== END EVENT ===")
+        tg_id = int(tg_id_raw)
+    except (TypeError, ValueError):
+        print(f"[WEBHOOK] Can't cast tg_id ({tg_id_raw}) to int!")
+        return None
+
+    product_type = metadata.get("product_type", "destiny")
+    if product_type not in PRODUCTS:
+        product_type = "destiny"
+    return tg_id, product_type
+
+async def fulfill(tg_id, product_type, session_id=None, received_at=None):
+    # Трасса заказа — id checkout-сессии: по нему потом ищется критический путь
+    with tracing.trace(session_id):
+        if received_at is not None:
+            tracing.record_span("stripe_inbox.wait", received_at, time.time(), tg_id=tg_id, product=product_type)
+        with tracing.span("webhook.fulfill", tg_id=tg_id, product=product_type):
+            await _fulfill(tg_id, product_type)
+
+async def _fulfill(tg_id, product_type):
+    if not await apply_payment(tg_id, product_type):
+        return
+    # Если webhook работает в процессе бота, оплаченная ссылка больше не выдаётся из кэша
+    forget_checkout(tg_id, product_type)
+    # Ставим отчёт в очередь бота (общий REPORT_QUEUE_PATH): к возвращению
+    # пользователя из Stripe PDF уже будет лежать в *_pdf_url
+    if product_type in PREGENERATE_PRODUCTS:
+        # Без получателя: если пользователь нажмёт кнопку раньше, чем отчёт готов,
+        # его запрос присоединится к этой задаче
+        job_id = enqueue_report(tg_id, product_type)
+        print(f"[WEBHOOK] Pre-generation job {job_id} queued for tg_id={tg_id}, {product_type}")
+
+async def process_batch(events):
+    # Одна покупка может прийти несколькими событиями — обновляем каждую пару
+    # (tg_id, product_type) один раз, а разные пары обрабатываем параллельно
+    orders = {}
+    keys = []
+    for event in events:
+        key = None
+        if event["type"] == "checkout.session.completed":
+            session = json.loads(event["payload"])["data"]["object"]
+            key = parse_checkout_session(session)
+            if key is not None and key not in orders:
+                orders[key] = fulfill(*key, session_id=session.get("id"), received_at=event["received_at"])
+        keys.append(key)
+
+    results = dict(zip(orders, await asyncio.gather(*orders.values(), return_exceptions=True)))
+    return [results.get(key) for key in keys]
+
+def describe_event(event):
+    # Для логов inbox: какой заказ не удалось обработать
+    if event["type"] != "checkout.session.completed":
+        return event["type"]
+    session = json.loads(event["payload"])["data"]["object"]
+    key = parse_checkout_session(session)
+    if key is None:
+        return f"{event['type']} {session.get('id')}"
+    return f"{event['type']} {session.get('id')}, tg_id={key[0]}, product={key[1]}"
 
+def dedupe_key(event):
+    obj = event["data"]["object"]
+    if obj.get("object") == "checkout.session":
+        return f"{event['type']}:{obj['id']}"
+    return None
+
+async def stripe_webhook(request: Request):
+    payload = await request.body()
+    sig_header = request.headers.get("stripe-signature")
     try:
         event = stripe.Webhook.construct_event(payload, sig_header, WEBHOOK_SECRET)
     except Exception as e:
         print("Webhook signature error:", e)
-        return str(e), 400
+        return PlainTextResponse(str(e), status_code=400)
 
-    try:
-        print(f"[WEBHOOK] Parsed event type: {event['type']}")
-        if event["type"] == "checkout.session.completed":
-            session = event["data"]["object"]
-            print(f"[WEBHOOK] session['metadata']: {session.get('metadata')}")
-            # Защитно достаём tg_id
-            tg_id_raw = session.get("metadata", {}).get("tg_id")
-            if not tg_id_raw:
-                print("[WEBHOOK] No tg_id in metadata! Cannot continue.")
-                return "", 200
-            try:
-                tg_id = int(tg_id_raw)
-            except Exception:
-                print(f"[WEBHOOK] Can't cast tg_id ({tg_id_raw}) to int!")
-                return "", 200
-
-            product_type = session.get("metadata", {}).get("product_type", "destiny")
-            paid_field = PRODUCTS.get(product_type, "paid_destiny")
-            print(f"[WEBHOOK] Will update_user(tg_id={tg_id}, {paid_field}=True)")
-
-            # Проверяем наличие пользователя
-            user = get_user(tg_id)
-            print(f"[WEBHOOK] Supabase user lookup for tg_id={tg_id}: {user}")
-            if not user:
-                print(f"[WEBHOOK] User with tg_id={tg_id} NOT FOUND in supabase. Update skipped!")
-                return "", 200
-
-            # Делаем апдейт
-            try:
-                result = update_user(tg_id, **{paid_field: True})
-                print(f"[WEBHOOK] update_user result: {result}")
-            except Exception as e:
-                print(f"[WEBHOOK] update_user exception: {e}")
+    # Подпись проверена — сохраняем событие и сразу отвечаем, остальное сделает consumer.
+    # Повторы Stripe отсекаются здесь, до любых запросов в Supabase
+    obj = event["data"]["object"]
+    session_id = obj.get("id") if obj.get("object") == "checkout.session" else None
+    with tracing.trace(session_id), tracing.span("stripe.webhook", event_type=event["type"]) as attrs:
+        attrs["new"] = stripe_inbox.add(event["id"], event["type"], payload.decode("utf-8"), dedupe_key(event))
+    return Response()
 
-    except Exception as e:
-        import traceback
-        print("Webhook handling error:", e)
-        traceback.print_exc()
-        # Всегда возвращаем 200, чтобы Stripe не спамил повторно!
-        return "", 200
+routes = [Route("/stripe/webhook", stripe_webhook, methods=["POST"])]
+
+async def start():
+    await stripe_inbox.start_consumer(process_batch, describe=describe_event)
+
+async def stop():
+    await stripe_inbox.stop_consumer()
+
+def register_metrics():
+    # Внутри server.py зовётся вместе с метриками бота; отдельный процесс регистрирует сам
+    metrics.register_stats("stripe_inbox", stripe_inbox.stats, counters=("received", "duplicates"))
+    metrics.register_stats(
+        "user_cache", users_repo.user_cache.stats, counters=("hits", "misses", "evictions")
+    )
+
+@asynccontextmanager
+async def lifespan(app):
+    register_metrics()
+    await start()
+    try:
+        yield
+    finally:
+        await stop()
+        await users_repo.close()
 
-    return "", 200
+# Отдельный процесс: uvicorn webhook:app --port 5000
+app = Starlette(routes=routes + [Route("/metrics", metrics.endpoint)], lifespan=lifespan)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=5000)